@@ -0,0 +1,98 @@
+#! /usr/bin/python
+
+"""Benchmarks of the generated bindings.
+
+By default, compare the per-call cost of the Python wrapper which
+the generated functions are until their first call, with the ctypes
+prototype they are afterwards (or from the start, when generated
+with generate.py -b), and with a wrapper method.
+
+With -i, report the import time and resident memory of generated
+modules, e.g. ni.py and a ni_lazy.py generated with generate.py -l.
+"""
+
+import ctypes
+import os
+import subprocess
+import sys
+import timeit
+
+N = 200000
+
+# Run in a fresh interpreter by imports()
+_IMPORT = """
+import resource, sys, time
+sys.path.insert(0, %r)
+r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t = time.time()
+import %s
+t = time.time() - t
+print('%%.1f %%d' %% (t * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - r))
+"""
+
+def percall(f, *args):
+    """Return the per-call time of f(*args) in microseconds.
+    """
+    t = timeit.Timer(lambda: f(*args))
+    return min(t.repeat(3, N)) / N * 1e6
+
+def calls(config=None):
+    """Report the per-call cost of xnGetDepthMap.
+    """
+    import ni
+
+    if config:
+        c = ni.Context(config)
+    else:
+        c = ni.Context()
+    if c is None:
+        print("Cannot create context.")
+        sys.exit(1)
+
+    h = ctypes.c_void_p()
+    if ni.dll.xnCreateDepthGenerator(c, ctypes.byref(h), ni.NodeQuery(), ni.EnumerationErrors()):
+        print("Error when creating depth generator")
+        sys.exit(1)
+    d = ni.NodeHandle(h)
+
+    wrapper = ni.xnGetDepthMap
+    wrapper(d)  # create the prototype
+    direct = ni._Cfunctions['xnGetDepthMap']
+    if wrapper is direct:
+        print("Module generated with -b: functions are directly bound")
+
+    print("xnGetDepthMap, first-call wrapper: %.3f us/call" % percall(wrapper, d))
+    print("xnGetDepthMap, bound prototype:    %.3f us/call" % percall(direct, d))
+    print("NodeHandle.getDepthMap method:     %.3f us/call" % percall(d.getDepthMap))
+
+def imports(modules, runs=5):
+    """Report the import time and resident memory of modules.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    for m in modules:
+        r = []
+        for i in range(runs):
+            out = subprocess.check_output([sys.executable, '-c', _IMPORT % (here, m)])
+            t, k = out.split()
+            r.append((float(t), int(k)))
+        t, k = min(r)
+        print("import %s: %.1f ms, +%d KiB resident" % (m, t, k))
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    opt = OptionParser(usage="""%prog  [options]  [Config.xml]
+
+Benchmark the generated bindings.""")
+
+    opt.add_option('-i', '--imports', dest='imports', action='store', type='str',
+                   default='',
+                   help='Comma-separated modules to time the import of, e.g. ni,ni_lazy')
+
+    opts, args = opt.parse_args()
+
+    if opts.imports:
+        imports(opts.imports.split(','))
+    else:
+        calls(args and args[0])
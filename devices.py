@@ -0,0 +1,285 @@
+#! /usr/bin/python3
+
+"""Capture from several devices, one process and context each.
+
+A single interpreter cannot keep up with more than one or two sensors.
+A DeviceManager enumerates the devices, starts a capture process per
+device, pinned to its own CPUs, which creates the generators of the
+device in its own context and publishes their maps with a
+L{frameserver.FrameServer}.  The manager merges the frames of all
+devices and reports the health of their processes:
+
+    manager = DeviceManager(streams=('depth', 'image'))
+    manager.start()
+    while True:
+        for d in manager.frames(timeout=1):
+            process(d.device, d.frames['depth'])
+        for h in manager.health().values():
+            if not h.alive or h.status:
+                ...
+
+The capture processes are spawned: the main module of the program
+must guard its code with if __name__ == '__main__'.  Python 3.8+ only.
+"""
+
+import collections
+import ctypes
+import multiprocessing
+import os
+import select
+import tempfile
+import time
+
+import frameserver
+import ni
+
+# Generator creation function and map view method of each stream
+STREAMS = {'depth': ('xnCreateDepthGenerator', 'getDepthMapView'),
+           'image': ('xnCreateImageGenerator', 'getImageMapView'),
+           'ir':    ('xnCreateIRGenerator',    'getIRMapView')}
+
+DeviceFrames = collections.namedtuple('DeviceFrames', 'device seq frames published')
+Health = collections.namedtuple('Health', 'device alive status frames fps timestamp')
+
+_functions = {}
+
+def _function(name, restype, *argtypes):
+    '''(INTERNAL) Return the binding of an OpenNI function which the
+    generated module may lack, e.g. from headers outside of INCLUDES.
+    '''
+    f = _functions.get(name, None)
+    if f is None:
+        f = _functions[name] = ctypes.CFUNCTYPE(restype, *argtypes)((name, ni.dll))
+    return f
+
+def devices(context=None):
+    """Return the creation info strings of the connected devices, in
+    enumeration order, None on error.
+    """
+    c = context or ni.Context()
+    t = ni.enumerations.enumerate(c, ni.PredefinedProductionNodeType.DEVICE)
+    if t is None:
+        return None
+    info = _function('xnNodeInfoGetCreationInfo', ctypes.c_char_p, ctypes.c_void_p)
+    return [info(i) for i in t]
+
+def _capture(index, creationInfo, streams, address, cpus, slots, health, stop):
+    '''(INTERNAL) Capture process of a device: publish its streams on
+    address and send its Health on the health connection, about once
+    a second, until stop is set.
+    '''
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    status, frames, fps, timestamp = 0, 0, 0.0, 0
+    server = None
+    try:
+        context = ni.Context()
+        t = devices(context) if context is not None else None
+        if t is None or creationInfo not in t:
+            status = -1  # device gone
+            return
+        device = ni.enumerations.create(context, ni.PredefinedProductionNodeType.DEVICE,
+                                        index=t.index(creationInfo))
+        if device is None:
+            status = -1
+            return
+        # Restrict the generators to the nodes of this device
+        query = ni.NodeQuery()
+        name = _function('xnGetNodeName', ctypes.c_char_p, ctypes.c_void_p)(device)
+        _function('xnNodeQueryAddNeededNode', ctypes.c_uint32,
+                  ctypes.c_void_p, ctypes.c_char_p)(query, name)
+        views = {}
+        for s in streams:
+            create, view = STREAMS[s]
+            h = ctypes.c_void_p()
+            status = getattr(ni.dll, create)(context, ctypes.byref(h), query, None)
+            if status:
+                ni.xnPrintError(status, ("%s generator creation" % s).encode())
+                return
+            views[s] = getattr(ni.NodeHandle(h), view)
+        status = context.startGeneratingAll()
+        if status:
+            ni.xnPrintError(status, b"Start generating")
+            return
+        server = frameserver.FrameServer(address, slots, **views)
+        last, count = time.time(), 0
+        while not stop.is_set():
+            status = context.waitAnyUpdateAll()
+            if status:
+                ni.xnPrintError(status, b"Update")
+            elif server.publish() is not None:
+                frames += 1
+                count += 1
+                timestamp = server.meta['timestamp'][server.seq % slots][0]
+            now = time.time()
+            if now - last >= 1:
+                fps = count / (now - last)
+                last, count = now, 0
+                health.send(Health(index, True, status, frames, fps, int(timestamp)))
+    finally:
+        if server is not None:
+            server.close()
+        health.send(Health(index, False, status, frames, fps, int(timestamp)))
+        health.close()
+
+class DeviceManager(object):
+    """Start and merge a capture process per device.
+
+    @param streams: the streams of each device, keys of STREAMS.
+    @param devices: creation info strings, by default all connected
+    devices, see L{devices}.
+    @param cpus: a list of CPU sets, one per device, None to split the
+    CPUs of this process evenly, or False not to pin the processes.
+    @param slots: the frame ring size of each device.
+    @param directory: the directory of the Unix sockets.
+    """
+    def __init__(self, streams=('depth',), devices=None, cpus=None, slots=8, directory=None):
+        for s in streams:
+            if s not in STREAMS:
+                raise ValueError('unknown stream %r' % (s,))
+        self.streams = tuple(streams)
+        self.devices = devices
+        self.cpus = cpus
+        self.slots = slots
+        self.directory = directory or tempfile.gettempdir()
+        self.processes = []
+        self.clients = {}  # device index: FrameClient
+        self.status = {}  # device index: latest Health
+        self._health = []  # receiving connections of the processes
+        self._stop = None
+
+    def _cpus(self, n):
+        '''(INTERNAL) Return the CPU sets of n processes.
+        '''
+        if self.cpus is not None:
+            return list(self.cpus or [None] * n)
+        if not hasattr(os, 'sched_getaffinity'):
+            return [None] * n
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < n:
+            return [None] * n
+        k = len(cpus) // n
+        return [set(cpus[i * k:(i + 1) * k]) for i in range(n)]
+
+    def start(self):
+        """Start the capture processes.
+
+        @return: the number of processes, None if the enumeration failed.
+        """
+        if self.devices is None:
+            # Enumerate in a child: a context of this process could
+            # keep the devices open, and spawned processes do not
+            # inherit it anyway.
+            mp = multiprocessing.get_context('spawn')
+            with mp.Pool(1) as pool:
+                self.devices = pool.apply(devices)
+            if self.devices is None:
+                return None
+        mp = multiprocessing.get_context('spawn')
+        self._stop = mp.Event()
+        cpus = self._cpus(len(self.devices))
+        for i, creationInfo in enumerate(self.devices):
+            address = os.path.join(self.directory, 'ni-%d-%d.sock' % (os.getpid(), i))
+            r, w = mp.Pipe(duplex=False)
+            p = mp.Process(target=_capture, name='ni-capture-%d' % i, daemon=True,
+                           args=(i, creationInfo, self.streams, address, cpus[i],
+                                 self.slots, w, self._stop))
+            p.start()
+            w.close()
+            p.address = address
+            self.processes.append(p)
+            self._health.append(r)
+            self.status[i] = Health(i, True, 0, 0, 0.0, 0)
+        return len(self.processes)
+
+    def _connect(self):
+        '''(INTERNAL) Connect to the frame servers which are up.
+        '''
+        for i, p in enumerate(self.processes):
+            if i not in self.clients and p.is_alive() and os.path.exists(p.address):
+                try:
+                    self.clients[i] = frameserver.FrameClient(p.address)
+                except OSError:  # not listening yet
+                    pass
+
+    def frames(self, timeout=None):
+        """Wait for new frames of any device.
+
+        @param timeout: in seconds, None to wait for frames however
+        long, including while the capture processes start.
+        @return: the list of the new DeviceFrames, at most one per
+        device, sorted by published, the time.monotonic() at which
+        their capture process published them: the device timestamps
+        come from unsynchronised clocks.  Empty on timeout, or if no
+        capture process is alive.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._connect()
+            if not self.clients:  # poll until a frame server is up
+                if not any(p.is_alive() for p in self.processes):
+                    return []
+                wait = 0.1 if end is None else min(0.1, end - time.monotonic())
+                if wait <= 0:
+                    return []
+                time.sleep(wait)
+                continue
+            clients = dict((c.fileno(), (i, c)) for i, c in self.clients.items())
+            left = None if end is None else max(0, end - time.monotonic())
+            t = []
+            for fd in select.select(list(clients), [], [], left)[0]:
+                i, c = clients[fd]
+                try:
+                    r = c.get(timeout=0)
+                except (EOFError, OSError):  # the process stopped
+                    c.close()
+                    del self.clients[i]
+                    continue
+                published = c.published(r[0]) if r is not None else None
+                if published is not None:  # else the slot was reused meanwhile
+                    t.append(DeviceFrames(i, r[0], r[1], published))
+            if t or left == 0:
+                t.sort(key=lambda d: d.published)
+                return t
+            # only layouts or disconnections, wait for the frames
+
+    def health(self):
+        """Return the latest Health of each device, by device index.
+        status is the last OpenNI status of the process, -1 if its
+        device could not be found or opened.
+        """
+        for r in self._health:
+            try:
+                while r.poll():
+                    h = r.recv()
+                    self.status[h.device] = h
+            except (EOFError, OSError):
+                pass
+        for i, p in enumerate(self.processes):
+            if not p.is_alive() and self.status[i].alive:
+                self.status[i] = self.status[i]._replace(alive=False)
+        return dict(self.status)
+
+    def stop(self, timeout=5):
+        """Stop the capture processes and disconnect.
+        """
+        if self._stop is not None:
+            self._stop.set()
+        for c in self.clients.values():
+            c.close()
+        self.clients = {}
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.health()
+        for r in self._health:
+            r.close()
+        self.processes = []
+        self._health = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
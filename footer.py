@@ -2,15 +2,840 @@
 # Start of footer.py #
 
 def error(s):
-    xnPrintError(s, "OpenNI error")
+    _printError(s, "OpenNI error")
 
 def debug(*args):
     '''Example callback, useful for debugging.
     '''
     print('Debug callback (%s)' % ', '.join(args))
 
+Frame = collections.namedtuple('Frame', 'data frameID timestamp')
+FrameBundle = collections.namedtuple('FrameBundle', 'depth image ir label')
+
+class FrameRing(object):
+    '''The last size frames of a generator, in one preallocated block.
+
+    Frames are copied into the slots of a single block, allocated on
+    the first push (and again if the map shape changes).  data is the
+    whole block, a read-only numpy array of shape (size,) + map shape
+    (a ctypes array without numpy); frameIDs, timestamps and nodes
+    hold the per-slot metadata.  Looking back with ring[age] or
+    index(age), age 0 being the latest frame, allocates nothing.
+
+    view is an optional bound NodeHandle.get*MapView method, used by
+    capture(): pass ring.capture as snapshot to a CaptureThread, or
+    call it after each update of your own loop.
+    '''
+    def __init__(self, size, view=None):
+        if size < 1:
+            raise ValueError('ring size must be positive')
+        self.size = size
+        self.view = view
+        self.node = getattr(view, '__self__', None)
+        self.shape = None
+        self.data = None
+        self.count = 0
+        self.head = -1
+        self._reset()
+
+    def _reset(self):
+        self.frameIDs = [None] * self.size
+        self.timestamps = [0] * self.size
+        self.nodes = [None] * self.size
+        self.frames = [None] * self.size
+
+    def _allocate(self, v):
+        '''(INTERNAL) Allocate the block for v-like frames.
+        '''
+        n = len(v.buffer)
+        size = ctypes.sizeof(v.buffer)
+        self.block = (v.ctype * (n * self.size))()
+        if numpy is not None:
+            a = numpy.frombuffer(self.block, dtype=numpy.dtype(v.ctype))
+            self.data = a.reshape((self.size,) + v.shape)
+            self.data.flags.writeable = False
+            self.slots = [self.data[i] for i in range(self.size)]
+        else:
+            self.data = self.block
+            self.slots = [(v.ctype * n).from_buffer(self.block, i * size)
+                          for i in range(self.size)]
+        self.shape = v.shape
+        self.nbytes = size
+        self.count = 0
+        self.head = -1
+        self._reset()
+
+    def push(self, v, node=None):
+        '''Copy the MapView v into the next slot and return its Frame.
+        '''
+        if v.shape != self.shape:
+            self._allocate(v)
+        i = (self.head + 1) % self.size
+        ctypes.memmove(ctypes.addressof(self.block) + i * self.nbytes,
+                       ctypes.addressof(v.buffer), self.nbytes)
+        self.frameIDs[i] = v.frameID
+        self.timestamps[i] = v.timestamp
+        self.nodes[i] = node
+        self.frames[i] = f = Frame(self.slots[i], v.frameID, v.timestamp)
+        self.head = i
+        self.count += 1
+        return f
+
+    def capture(self):
+        '''Push the current frame of the view node, if it is a new one.
+
+        Return the latest Frame, None if there is no data yet.
+        '''
+        if self.head < 0 or self.frameIDs[self.head] != xnGetFrameID(self.node):
+            v = self.view()
+            if v is not None:
+                return self.push(v, self.node)
+        return self.latest()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def index(self, age=0):
+        '''Return the slot index of the frame age frames back.
+        '''
+        if not 0 <= age < len(self):
+            raise IndexError('frame ring age out of range')
+        return (self.head - age) % self.size
+
+    def __getitem__(self, age):
+        return self.frames[self.index(age)]
+
+    def latest(self):
+        '''Return the latest Frame, None if empty.
+        '''
+        if self.head < 0:
+            return None
+        return self.frames[self.head]
+
+    def nearest(self, timestamp, tolerance):
+        '''Return the Frame closest to timestamp, None if farther than tolerance.
+        '''
+        best, d = None, tolerance
+        for i, f in enumerate(self.frames):
+            if f is not None and abs(self.timestamps[i] - timestamp) <= d:
+                best, d = f, abs(self.timestamps[i] - timestamp)
+        return best
+
+class FrameSync(object):
+    '''Synchronized snapshots of the depth, image, IR and label maps.
+
+    Each stream keeps a FrameRing of history frames, so that taking a
+    snapshot copies new frames without allocating buffers.  The
+    arrays of a FrameBundle are read-only and remain valid until
+    their slot is reused, i.e. for history - 1 further new frames.
+
+    If tolerance (in timestamp units, i.e. microseconds) is given,
+    the other streams are paired with the first configured one
+    (depth, image, ir, label) by nearest timestamp, and set to None
+    when no frame lies within tolerance.
+    '''
+    def __init__(self, depth=None, image=None, ir=None, label=None,
+                       tolerance=None, history=2):
+        if tolerance is not None and history < 2:
+            raise ValueError('timestamp pairing needs a history of 2 or more')
+        self.tolerance = tolerance
+        self.streams = []
+        for name, node in (('depth', depth), ('image', image),
+                           ('ir', ir), ('label', label)):
+            if node is None:
+                s = None
+            else:
+                m = {'depth': node.getDepthMapView,
+                     'image': node.getImageMapView,
+                     'ir':    node.getIRMapView,
+                     'label': node.getLabelMapView}[name]
+                s = FrameRing(history, m)
+            self.streams.append(s)
+
+    def snapshot(self):
+        '''Take in new frames and return a FrameBundle.
+
+        Call right after an update, see Context.waitAndUpdateFrames().
+        '''
+        ref = None
+        for s in self.streams:
+            if s is not None:
+                f = s.capture()
+                if ref is None:
+                    ref = f
+        if self.tolerance is None or ref is None:
+            return FrameBundle(*[s.latest() if s is not None else None
+                                 for s in self.streams])
+        return FrameBundle(*[s.nearest(ref.timestamp, self.tolerance)
+                             if s is not None else None
+                             for s in self.streams])
+
+class DropPolicy(object):
+    '''CaptureThread policies for a full frame queue.
+    '''
+    OLDEST = 'drop-oldest'  # discard the oldest queued frame
+    NEWEST = 'drop-newest'  # discard the new frame
+    BLOCK  = 'block'        # wait for the consumer
+
+class CaptureThread(threading.Thread):
+    '''Run the context updates in a dedicated thread.
+
+    After each successful update, snapshot() is called in the capture
+    thread and its result is pushed into a queue of at most maxsize
+    frames, read with get().  When the queue is full, policy (see
+    DropPolicy) tells what to do; dropped counts the discarded frames.
+
+    snapshot() must return data that outlives the next update, e.g.
+    a MapView.copy(), or a FrameSync snapshot with a history of at
+    least maxsize + 2 with the DropPolicy.BLOCK policy.
+
+    update defaults to context.waitAndUpdateAll.  The thread stops on
+    the first update error, whose status is then kept in status.
+    '''
+    def __init__(self, context, snapshot, maxsize=2,
+                       policy=DropPolicy.OLDEST, update=None):
+        if policy not in (DropPolicy.OLDEST, DropPolicy.NEWEST, DropPolicy.BLOCK):
+            raise ValueError('unknown drop policy %r' % (policy,))
+        threading.Thread.__init__(self, name='OpenNI capture')
+        self.daemon = True
+        self.context = context
+        self.snapshot = snapshot
+        self.update = update or context.waitAndUpdateAll
+        self.maxsize = maxsize
+        self.policy = policy
+        self.captured = 0
+        self.dropped = 0
+        self.status = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = True
+
+    def run(self):
+        q, cond = self._queue, self._cond
+        try:
+            while self._running:
+                status = self.update()
+                if status:
+                    self.status = status
+                    _printError(status, "Capture update")
+                    break
+                frame = self.snapshot()
+                with cond:
+                    self.captured += 1
+                    if len(q) >= self.maxsize:
+                        if self.policy == DropPolicy.NEWEST:
+                            self.dropped += 1
+                            continue
+                        elif self.policy == DropPolicy.OLDEST:
+                            q.popleft()
+                            self.dropped += 1
+                        else:
+                            while self._running and len(q) >= self.maxsize:
+                                cond.wait()
+                            if not self._running:  # stopped while waiting
+                                self.dropped += 1
+                                break
+                    q.append(frame)
+                    cond.notify_all()
+        finally:  # wake up get() even if update or snapshot raised
+            with cond:
+                self._running = False
+                cond.notify_all()
+
+    def get(self, timeout=None):
+        '''Return the oldest queued frame.
+
+        Return None on timeout, or when the thread is stopped and
+        no frame is left.
+        '''
+        with self._cond:
+            # Condition.wait_for(), which Python 2 lacks
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._queue and self._running:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    t = deadline - time.time()
+                    if t <= 0:
+                        break
+                    self._cond.wait(t)
+            if not self._queue:
+                return None
+            frame = self._queue.popleft()
+            self._cond.notify_all()
+            return frame
+
+    def __iter__(self):
+        '''Iterate over frames until the thread is stopped.
+        '''
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def stop(self):
+        '''Ask the thread to stop after the current update.
+        '''
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+class AsyncFrames(object):
+    '''Asynchronous iterator over the updates of a context.
+
+    New-data callbacks are registered on nodes.  Once all of them (or
+    any of them, if any is True) have signalled new data, the context
+    is updated with waitNoneUpdateAll, which does not block, and the
+    iteration yields snapshot(), or the update status if snapshot is
+    None.  The callbacks run in an OpenNI thread and only hand over
+    to the event loop through call_soon_threadsafe.
+
+    Iteration stops on close() or on the first update error, whose
+    status is then kept in status.
+
+    Without loop, create it in a coroutine: it uses the running loop.
+    '''
+    def __init__(self, context, nodes, snapshot=None, any=False, loop=None):
+        import asyncio  # not at module level, it is slow to import
+        self.context = context
+        self.snapshot = snapshot
+        self.any = any
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except AttributeError:  # no get_running_loop before Python 3.7
+                loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.status = 0
+        self._nodes = list(nodes)
+        self._arrived = set()
+        self._waiter = None
+        self._closed = False
+        # keep a reference, ctypes does not
+        self._handler = cb.StateChangedHandler(self._signal)
+        self._handles = []
+        for i, node in enumerate(self._nodes):
+            h = ctypes.c_void_p()
+            status = dll.xnRegisterToNewDataAvailable(node, self._handler,
+                                                      ctypes.c_void_p(i),
+                                                      ctypes.byref(h))
+            if status:
+                _printError(status, "New data callback registration")
+                self.close()
+                break
+            self._handles.append((node, h))
+
+    def _signal(self, hNode, pCookie):
+        '''(INTERNAL) New data callback, called in an OpenNI thread.
+        '''
+        try:
+            self.loop.call_soon_threadsafe(self._arrive, pCookie or 0)
+        except RuntimeError:  # loop closed
+            pass
+
+    def _ready(self):
+        if self.any:
+            return bool(self._arrived)
+        return len(self._arrived) == len(self._nodes)
+
+    def _arrive(self, i):
+        self._arrived.add(i)
+        w = self._waiter
+        if w is not None and not w.done() and self._ready():
+            self._waiter = None
+            self._resolve(w)
+
+    def _resolve(self, waiter):
+        '''(INTERNAL) Update the context and resolve waiter.
+        '''
+        self._arrived.clear()
+        status = self.context.waitNoneUpdateAll()
+        if status:
+            # resolve first, reporting must not leave the waiter pending
+            self.status = status
+            self.close()
+            waiter.set_exception(_StopAsync())
+            _printError(status, "Async update")
+        elif self.snapshot is None:
+            waiter.set_result(status)
+        else:
+            try:
+                waiter.set_result(self.snapshot())
+            except Exception as e:
+                waiter.set_exception(e)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        '''Return a future of the next frame.
+        '''
+        w = self.loop.create_future()
+        if self._closed:
+            w.set_exception(_StopAsync())
+        elif self._ready():
+            self._resolve(w)
+        else:
+            self._waiter = w
+        return w
+
+    def once(self):
+        '''Return a future of the next frame, then close.
+        '''
+        w = self.__anext__()
+        w.add_done_callback(lambda w: self.close())
+        return w
+
+    def close(self):
+        '''Unregister the new-data callbacks and stop the iteration.
+        '''
+        self._closed = True
+        for node, h in self._handles:
+            dll.xnUnregisterFromNewDataAvailable(node, h)
+        self._handles = []
+        w, self._waiter = self._waiter, None
+        if w is not None and not w.done():
+            w.set_exception(_StopAsync())
+
+class HandlePool(object):
+    """Pool of EnumerationErrors or NodeInfoList instances, which are
+    cleared and reused rather than allocated for each enumeration:
+
+        pool = HandlePool(EnumerationErrors)
+        with pool.borrow() as errors:
+            ...
+
+    At most maxsize idle instances are kept, the others are freed.
+    """
+    _clear = {'EnumerationErrors': 'xnEnumerationErrorsClear',
+              'NodeInfoList':      'xnNodeInfoListClear'}
+
+    def __init__(self, cls, maxsize=4):
+        if cls.__name__ not in self._clear:
+            raise TypeError('%s instances cannot be cleared' % (cls.__name__,))
+        self.cls = cls
+        self.maxsize = maxsize
+        self.idle = collections.deque()
+        self.allocated = 0  # instances created by the pool
+
+    def get(self):
+        """Return an idle instance, or a new one.
+        """
+        try:
+            return self.idle.pop()
+        except IndexError:
+            self.allocated += 1
+            return self.cls()
+
+    def put(self, o):
+        """Clear instance o and keep it for reuse, or free it if the
+        pool is full.
+        """
+        if len(self.idle) < self.maxsize and \
+           not getattr(dll, self._clear[self.cls.__name__])(o):
+            self.idle.append(o)
+        else:
+            o.free()
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """Context manager returning an instance to the pool on exit.
+        """
+        o = self.get()
+        try:
+            yield o
+        finally:
+            self.put(o)
+
+class EnumerationCache(object):
+    """Cache of production tree enumerations, which probe the devices
+    and are slow, e.g. to create several generators at startup:
+
+        depth = enumerations.create(context, PredefinedProductionNodeType.DEPTH)
+
+    Entries are dropped by invalidate(), when nodes are created or
+    destroyed in a watch()ed context, or after maxage seconds if set.
+    OpenNI does not report device hotplug: call invalidate() from the
+    application hotplug handler, if any.
+    """
+    def __init__(self, maxage=None):
+        self.maxage = maxage
+        self.entries = {}  # (context, type, key): (time, NodeInfos)
+        self.handles = []  # (context, unregister function, callback handle, handler)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self._local = threading.local()  # creating: in create(), see watch()
+
+    def enumerate(self, context, type, query=None, key=None):
+        """Return the NodeInfos of the production trees of type, cached.
+
+        @param query: optional NodeQuery.
+        @param key: hashable description of the query, to share entries
+        between equivalent queries.  By default, the query itself: it
+        should not be changed after its first enumeration.
+        @return: NodeInfos, None on error.
+        """
+        k = (context, int(type), query if key is None else key)
+        with self.lock:
+            e = self.entries.get(k, None)
+            if e is not None and (self.maxage is None or
+                                  time.time() - e[0] < self.maxage):
+                self.hits += 1
+                return e[1]
+        p = ctypes.c_void_p()
+        status = dll.xnEnumerateProductionTrees(context, int(type), query, ctypes.byref(p), None)
+        if status:
+            _printError(status, "Production trees enumeration")
+            return None
+        l = NodeInfoList(p)
+        t = _Cown(l, dll.xnNodeInfoListFree).infos()
+        with self.lock:
+            self.misses += 1
+            self.entries[k] = (time.time(), t)
+        return t
+
+    def create(self, context, type, query=None, key=None, index=0):
+        """Create the production tree at index of the cached enumeration,
+        see enumerate().
+
+        @return: the NodeHandle, None on error.
+        """
+        t = self.enumerate(context, type, query, key)
+        if t is None:
+            return None
+        h = ctypes.c_void_p()
+        self._local.creating = True
+        try:
+            status = dll.xnCreateProductionTree(context, t[index], ctypes.byref(h))
+        finally:
+            self._local.creating = False
+        if status:
+            _printError(status, "Production tree creation")
+            return None
+        return NodeHandle(h)
+
+    def invalidate(self, context=None):
+        """Drop the entries of context, or all of them.  The lists are
+        freed once their NodeInfos are no longer referenced.
+        """
+        with self.lock:
+            if context is None:
+                self.entries.clear()
+            else:
+                for k in [k for k in self.entries if k[0] is context]:
+                    del self.entries[k]
+
+    def watch(self, context):
+        """Invalidate the entries of context when nodes are created or
+        destroyed in it, except by create(): the enumeration it used
+        stays valid for the creation of further generators.
+        """
+        def invalidate(*unused):
+            if not getattr(self._local, 'creating', False):
+                self.invalidate(context)
+        for r, u, c in ((dll.xnRegisterToNodeCreation, dll.xnUnregisterFromNodeCreation,
+                         cb.NodeCreationHandler(invalidate)),
+                        (dll.xnRegisterToNodeDestruction, dll.xnUnregisterFromNodeDestruction,
+                         cb.NodeDestructionHandler(invalidate))):
+            h = ctypes.c_void_p()
+            status = r(context, c, None, ctypes.byref(h))
+            if status:
+                _printError(status, "Node creation/destruction callback")
+            else:
+                self.handles.append((context, u, h, c))
+
+    def close(self):
+        """Unregister the callbacks of watch() and drop all entries.
+        """
+        for context, u, h, _ in self.handles:
+            u(context, h)
+        self.handles = []
+        self.invalidate()
+
+# Process-wide enumeration cache
+enumerations = EnumerationCache()
+
+Event = collections.namedtuple('Event', 'type node user timestamp')
+
+class EventQueue(object):
+    """Queue of OpenNI callback events, drained in batches by the
+    application rather than handled in the OpenNI thread:
+
+        events = EventQueue()
+        events.registerUserCallbacks(user)
+        while True:
+            for e in events.wait():
+                ...
+
+    The callbacks only append a (type, node, user, timestamp) tuple to
+    a deque, which does not lock: ctypes still takes the GIL to call
+    them, but holds it for that append only.  Events are Event tuples,
+    user is None for callbacks without a user ID.
+    """
+    def __init__(self):
+        self.queue = collections.deque()
+        self.ready = threading.Event()
+        self.callbacks = {}  # handle value: (node, unregister function, handlers)
+
+    def _trampoline(self, type):
+        '''(INTERNAL) Return the Python function of a callback, which
+        records events of type.  The user ID is the first integer
+        argument after the node, if any.
+        '''
+        append = self.queue.append
+        ready = self.ready
+        clock = time.time
+        def trampoline(hNode, *args):
+            user = None
+            for a in args[:-1]:  # not the cookie
+                if isinstance(a, _Ints):
+                    user = a
+                    break
+            append((type, hNode, user, clock()))
+            if not ready.is_set():
+                ready.set()
+        return trampoline
+
+    def register(self, node, register, unregister, *events):
+        """Register callbacks queueing events, with the C functions
+        register(node, handler..., cookie, &handle) and
+        unregister(node, handle), e.g.:
+
+            events.register(user, dll.xnRegisterToUserExit, dll.xnUnregisterFromUserExit,
+                            ('user exit', cb.UserHandler))
+
+        @param events: (type, callback decorator) of each handler.
+        @return: the callback handle, for unregister(); None on error.
+        """
+        handlers = tuple(c(self._trampoline(t)) for t, c in events)
+        h = ctypes.c_void_p()
+        status = register(node, *(handlers + (None, ctypes.byref(h))))
+        if status:
+            _printError(status, "Callback registration")
+            return None
+        # keep a reference, ctypes does not
+        self.callbacks[h.value] = (node, unregister, handlers)
+        return h
+
+    def registerUserCallbacks(self, node):
+        """Queue the 'new user' and 'lost user' events of a user generator.
+
+        @return: the callback handle, None on error.
+        """
+        return self.register(node, dll.xnRegisterUserCallbacks, dll.xnUnregisterUserCallbacks,
+                             ('new user', cb.UserHandler), ('lost user', cb.UserHandler))
+
+    def registerToNewDataAvailable(self, node):
+        """Queue the 'new data' events of a generator.
+
+        @return: the callback handle, None on error.
+        """
+        return self.register(node, dll.xnRegisterToNewDataAvailable,
+                             dll.xnUnregisterFromNewDataAvailable,
+                             ('new data', cb.StateChangedHandler))
+
+    def unregister(self, handle):
+        """Unregister the callbacks of a handle returned by register().
+        Queued events are kept.
+        """
+        v = getattr(handle, 'value', handle)
+        node, unregister, _ = self.callbacks.pop(v)
+        unregister(node, ctypes.c_void_p(v))
+
+    def drain(self, coalesce=True):
+        """Return the queued Events, oldest first.
+
+        @param coalesce: keep only the last of the events with the same
+        type, node and user.
+        """
+        pop = self.queue.popleft
+        self.ready.clear()
+        batch = []
+        try:
+            while True:
+                batch.append(pop())
+        except IndexError:
+            pass
+        # node pointer values, ctypes passes a new object to each call
+        batch = [(t, getattr(n, 'value', n), u, s) for t, n, u, s in batch]
+        if coalesce and len(batch) > 1:
+            last = dict((e[:3], i) for i, e in enumerate(batch))
+            if len(last) < len(batch):
+                batch = [batch[i] for i in sorted(last.values())]
+        return [Event(t, NodeHandle(n) if n else None, u, s) for t, n, u, s in batch]
+
+    def wait(self, timeout=None, coalesce=True):
+        """Wait for events for at most timeout seconds and drain them.
+
+        @return: the Events, an empty list on timeout.
+        """
+        self.ready.wait(timeout)
+        return self.drain(coalesce)
+
+    def close(self):
+        """Unregister all callbacks and drop the queued events.
+        """
+        for h, (node, unregister, _) in list(self.callbacks.items()):
+            unregister(node, ctypes.c_void_p(h))
+        self.callbacks.clear()
+        self.queue.clear()
+        self.ready.clear()
+
+class WaitScheduler(object):
+    """Context updates with the wait strategy of least latency for a
+    set of target generators:
+
+        scheduler = WaitScheduler(context, [depth, image], targets=[image])
+        while not scheduler.update():
+            ...
+
+    The candidate strategies are tried for window updates each, after
+    a first window measuring the frame rates, then the one with the
+    least mean latency of the target frames is kept: waitAndUpdateAll,
+    only if all generators are targets with the same frame rate,
+    waitOneUpdateAll on the fastest target and waitAnyUpdateAll.  With
+    mixed frame rates, waitAndUpdateAll returns at the pace of the
+    slowest generator, up to a frame period late for the others.
+
+    The latency of a frame is the host time of its update minus its
+    device timestamp, less the least such difference seen for the
+    generator: it is relative to the fastest delivery observed.
+
+    If busy is True, isNewDataAvailable is polled rather than blocking
+    in OpenNI, for at most two frame periods, then waitNoneUpdateAll
+    updates the context: this trades a CPU for the wake-up latency.
+    """
+    def __init__(self, context, nodes, targets=None, busy=False, window=30):
+        self.context = context
+        self.nodes = list(nodes)
+        self.targets = list(targets or self.nodes)
+        self.busy = busy
+        self.window = window
+        self.periods = {}  # node: frame period, seconds
+        self.latencies = dict((n, collections.deque(maxlen=window)) for n in self.targets)
+        self.results = []  # (mean latency, strategy) of the tried strategies
+        self._frames = {}  # node: (frame ID, timestamp)
+        self._offsets = {}  # node: least host time - device timestamp
+        self._timestamp = ctypes.c_uint64()
+        self.recalibrate()
+
+    def recalibrate(self):
+        """Measure the frame rates and try the strategies again, e.g.
+        after an output mode change.
+        """
+        self.strategy = ('any', None)  # (how, node) of the waits
+        self.calibrating = True
+        self.results = []
+        self._trials = None  # the strategies left to try, once the rates are known
+        self._count = 0
+        for l in self.latencies.values():
+            l.clear()
+
+    def update(self):
+        """Wait for new data with the current strategy and update the
+        context.
+
+        @return: the status of the update.
+        """
+        how, node = self.strategy
+        if self.busy and self._poll(how, node):
+            status = self.context.waitNoneUpdateAll()
+        elif how == 'one':
+            status = self.context.waitOneUpdateAll(node)
+        elif how == 'and':
+            status = self.context.waitAndUpdateAll()
+        else:
+            status = self.context.waitAnyUpdateAll()
+        if not status:
+            self._measure()
+        return status
+
+    def latency(self):
+        """Return the mean latency of the recent target frames, in
+        seconds, None before the first frames.
+        """
+        t = [l for n in self.targets for l in self.latencies[n]]
+        return sum(t) / len(t) if t else None
+
+    def report(self):
+        """Return a dict of the current strategy, the frame periods and
+        the (mean, max) latency of each target, in seconds.
+        """
+        return {'strategy': self.strategy,
+                'periods': dict(self.periods),
+                'latencies': dict((n, (sum(l) / len(l), max(l)))
+                                  for n, l in self.latencies.items() if l)}
+
+    def _poll(self, how, node):
+        '''(INTERNAL) Busy-wait for the new data of a strategy, for at
+        most two frame periods.  Return True if it is available.
+        '''
+        nodes = [node] if how == 'one' else self.nodes
+        ready = all if how == 'and' else any
+        deadline = time.time() + 2 * max(self.periods.get(n, 0.1) for n in nodes)
+        timestamp = ctypes.byref(self._timestamp)
+        while not ready([dll.xnIsNewDataAvailable(n, timestamp) for n in nodes]):
+            if time.time() > deadline:
+                return False
+            time.sleep(0)  # let other threads run
+        return True
+
+    def _measure(self):
+        '''(INTERNAL) Update the frame periods and latencies after an
+        update, and the strategy while calibrating.
+        '''
+        now = time.time()
+        for n in self.nodes:
+            f = (xnGetFrameID(n), xnGetTimestamp(n))
+            last = self._frames.get(n, None)
+            self._frames[n] = f
+            if last is None or f[0] <= last[0]:
+                continue
+            t = (f[1] - last[1]) / 1e6 / (f[0] - last[0])
+            p = self.periods.get(n, None)
+            self.periods[n] = t if p is None else p + (t - p) / 8
+            if n in self.latencies:
+                d = now - f[1] / 1e6
+                o = min(self._offsets.get(n, d), d)
+                self._offsets[n] = o
+                self.latencies[n].append(d - o)
+        if self.calibrating:
+            self._count += 1
+            if self._count >= self.window:
+                self._next()
+
+    def _next(self):
+        '''(INTERNAL) End the trial of the current strategy and start
+        the next one, or keep the best.
+        '''
+        if self._trials is None:  # the first window only measures the rates
+            self._trials = self._candidates()
+        else:
+            l = self.latency()
+            self.results.append((float('inf') if l is None else l, self.strategy))
+        if self._trials:
+            self.strategy = self._trials.pop(0)
+        else:
+            self.strategy = min(self.results, key=lambda r: r[0])[1]
+            self.calibrating = False
+        self._count = 0
+        for l in self.latencies.values():
+            l.clear()
+
+    def _candidates(self):
+        '''(INTERNAL) Return the strategies to try.
+        '''
+        p = [self.periods.get(n, None) for n in self.targets]
+        if None in p:  # no frames yet
+            return [('any', None)]
+        c = [('one', self.targets[p.index(min(p))]), ('any', None)]
+        if len(self.targets) == len(self.nodes) and max(p) < min(p) * 1.1:
+            c.insert(0, ('and', None))
+        return c
+
 if __name__ == '__main__':
-    import time
 
     #c = Context('/home/oaubert/src/kinect/Nite-1.3.0.18/Data/Sample-User.xml')
     c = Context()
@@ -23,11 +848,11 @@ if __name__ == '__main__':
     #q.addSupportedMapOutputMode(output)    
     #c.createDepthGenerator(q, err)
     
-    u=c.createUserGenerator(q)
+    u=c.createUserGenerator(q, err)
     if not u.isCapabilitySupported('User::Skeleton'):
         raise "Unable to create UserGenerator"
     h=u.registerUserCallbacks(cb.UserHandler(debug), cb.UserHandler(debug), "User")
-    print "Registered cb %x" % h
+    print("Registered cb %x" % h)
     s=c.startGeneratingAll()
     if s:
         error(s)
@@ -35,7 +860,7 @@ if __name__ == '__main__':
         s=c.waitNoneAndUpdateAll()
         if s:
             error(s)
-        print "Update", u.getUsers()
+        print("Update %s" % (u.getUsers(),))
         time.sleep(.1)
 
 
@@ -0,0 +1,325 @@
+#! /usr/bin/python3
+
+"""Zero-copy fan-out of frames to local worker processes.
+
+Only one process can own the OpenNI context.  A FrameServer in that
+process copies the maps of its generators once per update into the
+slots of a multiprocessing.shared_memory ring, and announces each new
+slot to the FrameClient of the other processes through a Unix socket.
+Clients map the slots as numpy arrays, without copying or pickling.
+
+    server = FrameServer('/tmp/ni.sock', depth=depth.getDepthMapView,
+                         image=image.getImageMapView)
+    while not context.waitAnyUpdateAll():
+        server.publish()
+
+    client = FrameClient('/tmp/ni.sock')
+    while True:
+        seq, frames = client.get()
+        process(frames['depth'].data)
+        if not client.valid(seq):
+            ...  # the slot was reused meanwhile, drop the result
+
+A slot is reused after slots further updates: a client which needs a
+frame longer should copy it.  Python 3.8+ only.
+"""
+
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+import numpy
+from multiprocessing import shared_memory
+
+import ni
+
+_seq = struct.Struct('=Q')  # notification: the sequence number of a slot
+_length = struct.Struct('=I')  # prefix of the JSON layout
+_untracked = threading.Lock()  # see FrameClient._attach
+
+def _align(n, alignment=64):
+    return (n + alignment - 1) // alignment * alignment
+
+def _meta(streams):
+    '''(INTERNAL) Return the dtype of the slot headers.  seq is 0 while
+    the slot is written, then the sequence number of its frames, which
+    were published at time.monotonic() published.
+    '''
+    return numpy.dtype([('seq', '<u8'),
+                        ('published', '<f8'),
+                        ('frameID', '<u8', (len(streams),)),
+                        ('timestamp', '<u8', (len(streams),))])
+
+def _arrays(buf, layout):
+    '''(INTERNAL) Return the slot headers and the dict of the
+    (slots,) + shape stream arrays of a shared memory buffer.
+    '''
+    slots = layout['slots']
+    meta = numpy.ndarray((slots,), _meta(layout['streams']), buffer=buf)
+    arrays = {}
+    for name, shape, dtype, offset in layout['streams']:
+        arrays[name] = numpy.ndarray((slots,) + tuple(shape), numpy.dtype(dtype),
+                                     buffer=buf, offset=offset)
+    return meta, arrays
+
+class FrameServer(object):
+    """Publish the maps of generators to FrameClients.
+
+    @param address: the path of the Unix socket.
+    @param slots: the number of frames of the ring.
+    @param views: name=view of each stream, view being a bound
+    L{ni.NodeHandle} get*MapView method.
+    """
+    def __init__(self, address, slots=8, **views):
+        if not views:
+            raise ValueError('no streams to publish')
+        self.address = address
+        self.slots = slots
+        self.views = sorted(views.items())
+        self.seq = 0
+        self.shm = None
+        self.layout = None
+        self.clients = []
+        if os.path.exists(address):
+            os.remove(address)  # left by a dead server
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(address)
+        self.socket.listen(8)
+        self.socket.setblocking(False)
+
+    def _allocate(self, maps):
+        '''(INTERNAL) Create the shared memory ring for maps.
+        '''
+        streams = []
+        offset = _align(_meta(self.views).itemsize * self.slots)
+        for (name, _), m in zip(self.views, maps):
+            a = m.array
+            streams.append((name, a.shape, a.dtype.str, offset))
+            offset += _align(a.nbytes * self.slots)
+        self.shm = shared_memory.SharedMemory(create=True, size=offset)
+        self.layout = {'name': self.shm.name, 'slots': self.slots, 'streams': streams}
+        self.meta, arrays = _arrays(self.shm.buf, self.layout)
+        self.arrays = [arrays[name] for name, _ in self.views]
+        self.clients = [c for c in self.clients if self._hello(c)]
+
+    def _hello(self, c):
+        '''(INTERNAL) Send the layout to client socket c.
+
+        @return: False if the client disconnected, and c is closed.
+        '''
+        s = json.dumps(self.layout).encode('utf-8')
+        try:
+            c.setblocking(True)
+            c.sendall(_length.pack(len(s)) + s)
+            c.setblocking(False)
+        except OSError:
+            c.close()
+            return False
+        return True
+
+    def _accept(self):
+        '''(INTERNAL) Accept the pending connections.
+        '''
+        while True:
+            try:
+                c, _ = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            if self.layout is None or self._hello(c):
+                self.clients.append(c)
+
+    def publish(self):
+        """Copy the current maps into the next slot and notify the
+        clients.  Call after each context update.
+
+        @return: the sequence number of the slot, None if a map has no
+        data yet.
+        """
+        self._accept()
+        maps = [view() for _, view in self.views]
+        if None in maps:
+            return None
+        if self.shm is None:
+            self._allocate(maps)
+        seq = self.seq + 1
+        i = seq % self.slots
+        meta = self.meta[i]
+        meta['seq'] = 0
+        for k, (a, m) in enumerate(zip(self.arrays, maps)):
+            if m.array.shape != a.shape[1:]:
+                raise ValueError('map shape changed from %r to %r' % (a.shape[1:], m.array.shape))
+            numpy.copyto(a[i], m.array)
+            meta['frameID'][k] = m.frameID
+            meta['timestamp'][k] = m.timestamp
+        meta['published'] = time.monotonic()
+        meta['seq'] = self.seq = seq
+        self._notify(_seq.pack(seq))
+        return seq
+
+    def _notify(self, message):
+        '''(INTERNAL) Send message to the clients, without blocking:
+        clients with a full socket buffer miss it, disconnected or
+        partially written ones are dropped.
+        '''
+        for c in list(self.clients):
+            try:
+                n = c.send(message)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                n = 0
+            if n < len(message):
+                self.clients.remove(c)
+                c.close()
+
+    def close(self):
+        """Disconnect the clients and free the shared memory.
+        """
+        for c in self.clients:
+            c.close()
+        self.clients = []
+        self.socket.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        if self.shm is not None:
+            self.meta = self.arrays = None  # release the buffer exports
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FrameClient(object):
+    """Receive the frames of a FrameServer.
+
+    @param address: the path of the server Unix socket.
+    """
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self._pending = b''
+        self.shm = None
+        self.layout = None
+
+    def fileno(self):
+        """The socket descriptor, readable on new frames: for select()
+        or an event loop add_reader().
+        """
+        return self.socket.fileno()
+
+    def _recv(self, n):
+        '''(INTERNAL) Receive exactly n bytes.
+        '''
+        b = b''
+        while len(b) < n:
+            s = self.socket.recv(n - len(b))
+            if not s:
+                raise EOFError('frame server closed')
+            b += s
+        return b
+
+    def _attach(self):
+        '''(INTERNAL) Receive the layout and map the shared memory.
+        '''
+        self.layout = json.loads(self._recv(_length.unpack(self._recv(_length.size))[0]).decode('utf-8'))
+        try:
+            self.shm = shared_memory.SharedMemory(self.layout['name'], track=False)
+        except TypeError:
+            # Before Python 3.13, the resource tracker would unlink it
+            # at exit, or complain if shared with the server process.
+            # Unregistering after attaching removes the registration of
+            # a server sharing the tracker: skip it instead, one client
+            # at a time, the patch being global.
+            from multiprocessing import resource_tracker
+            with _untracked:
+                register = resource_tracker.register
+                resource_tracker.register = lambda name, rtype: None
+                try:
+                    self.shm = shared_memory.SharedMemory(self.layout['name'])
+                finally:
+                    resource_tracker.register = register
+        self.meta, arrays = _arrays(self.shm.buf, self.layout)
+        for a in arrays.values():
+            a.flags.writeable = False
+        self.names = [s[0] for s in self.layout['streams']]
+        self.arrays = [arrays[name] for name in self.names]
+
+    def get(self, timeout=None, latest=True):
+        """Wait for a new slot.
+
+        @param latest: skip to the newest announced slot, rather than
+        returning each of them in turn.
+        @return: (seq, {name: L{ni.Frame}}), the frame data being
+        read-only arrays in the shared memory; None on timeout.
+        """
+        if self.shm is None:
+            if timeout is not None and not select.select([self], [], [], timeout)[0]:
+                return None
+            self._attach()
+        while True:
+            n = len(self._pending) // _seq.size
+            if n and not latest:
+                seq = _seq.unpack_from(self._pending)[0]
+                self._pending = self._pending[_seq.size:]
+            elif n and not select.select([self], [], [], 0)[0]:
+                seq = _seq.unpack_from(self._pending, (n - 1) * _seq.size)[0]
+                self._pending = self._pending[n * _seq.size:]
+            else:
+                if not n and timeout is not None and not select.select([self], [], [], timeout)[0]:
+                    return None
+                s = self.socket.recv(4096)
+                if not s:
+                    raise EOFError('frame server closed')
+                self._pending += s
+                continue
+            frames = self.frames(seq)
+            if frames is not None:
+                return seq, frames
+            # overwritten before being read, wait for the next one
+
+    def frames(self, seq):
+        """Return the {name: L{ni.Frame}} of slot seq, None if it has
+        been reused.
+        """
+        i = seq % len(self.meta)
+        meta = self.meta[i]
+        frames = dict((name, ni.Frame(a[i], int(meta['frameID'][k]), int(meta['timestamp'][k])))
+                      for k, (name, a) in enumerate(zip(self.names, self.arrays)))
+        return frames if self.valid(seq) else None
+
+    def published(self, seq):
+        """Return the time.monotonic() at which slot seq was published,
+        comparable between the processes of a host, or None if the
+        slot has been reused.
+        """
+        t = float(self.meta['published'][seq % len(self.meta)])
+        return t if self.valid(seq) else None
+
+    def valid(self, seq):
+        """Return True if slot seq still holds the frames of seq: check
+        after reading them.
+        """
+        return int(self.meta['seq'][seq % len(self.meta)]) == seq
+
+    def close(self):
+        """Disconnect and unmap the shared memory.
+        """
+        self.socket.close()
+        if self.shm is not None:
+            self.meta = self.arrays = None  # release the buffer exports
+            self.shm.close()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
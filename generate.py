@@ -79,6 +79,7 @@ version_re   = re.compile('\d+[.]\d+[.]\d+.*')
 xncallback_re = re.compile('\(XN_CALLBACK_TYPE\*\s+(\S+)\)')
 callbackdef_re = re.compile('typedef\s+(\w+)\s+\(XN_CALLBACK_TYPE\*\s+(\w+)\)\((.+)\);')
 define_re    = re.compile('^#define\s+(XN_\S+)\s+(\S+)')
+ident_re     = re.compile('[A-Za-z_]\w*')
 
 def endot(text):
     """Terminate string with a period.
@@ -231,6 +232,12 @@ class Func(_Source):
         return [p.name for p in self.pars[first:] if
                 p.flags(self.out)[0] != Flag.Out]
 
+    def outs(self):
+        """Return the names of the output parameters, see L{args}.
+        """
+        return [p.name for p in self.pars if
+                p.flags(self.out)[0] == Flag.Out]
+
     def check(self):
         """Perform some consistency checks.
         """
@@ -312,9 +319,10 @@ class Func(_Source):
 class Par(object):
     """C function parameter.
     """
-    def __init__(self, name, type):
+    def __init__(self, name, type, length=''):
         self.name = name
         self.type = type  # C type
+        self.length = length  # C array length
 
     def dump(self, out=()):  # for debug
         if self.name in out:
@@ -347,7 +355,6 @@ class Par(object):
         else:
             f = {'int*':      Flag.Out,
                  'unsigned*': Flag.Out,
-                 'XnEnumerationErrors*': Flag.Out,
                 }.get(self.type, Flag.In)  # default
         if default is None:
             return f,  # 1-tuple
@@ -669,11 +676,13 @@ class Parser(object):
             # varargs spec
             n = 'varargs'
 
+        l = ''
         if '[' in n:
-            n = n[:n.index('[')]
+            n, l = n.split('[', 1)
+            l = l.split(']', 1)[0].strip()
             t += '*'
 
-        return Par(n, t.strip())
+        return Par(n.strip(), t.strip(), l)
 
 
 class _Generator(object):
@@ -681,11 +690,13 @@ class _Generator(object):
     """
     comment_line = '#'   # Python
     file         = None
+    lazy         = False  # see PythonGenerator.generate_lazy
     links        = {}    # must be overloaded
     outdir       = ''
     outpath      = ''
     type_re      = None  # must be overloaded
     type2class   = {}    # must be overloaded
+    enum_classes = set()  # set in __init__
 
     def __init__(self, parser=None):
       ##self.type2class = self.type2class.copy()
@@ -694,6 +705,7 @@ class _Generator(object):
         self.convert_classnames('struct')
         self.convert_classnames('private')
         self.convert_classnames('callback')
+        self.enum_classes = set(self.class4(e.name) for e in parser.enums)
 
     def check_types(self):
         """Make sure that all types are properly translated.
@@ -713,7 +725,33 @@ class _Generator(object):
     def class4(self, c_name):
         """Return the class name for a type or enum.
         """
-        return self.type2class.get(c_name, '') or ('FIXME_%s' % (c_name,))
+        c = self.type2class.get(c_name, '')
+        if not c and c_name.endswith('*'):
+            # enum pointers point to the enum ctypes type, see ref4
+            e = self.type2class.get(c_name[:-1], '')
+            if e in self.enum_classes:
+                c = 'ctypes.POINTER(%s._ctype_)' % (e,)
+        return c or ('FIXME_%s' % (c_name,))
+
+    def ref4(self, c_name):
+        """Return the class name for a type built by ctypes, i.e. a
+        function result, a callback argument or a struct field.
+
+        Wrapper classes are replaced by their reference class, which
+        ctypes can build and which converts to the wrapper class, and
+        enum classes by their ctypes type, which converts to the enum,
+        also when pointed to.
+        """
+        c = self.class4(c_name)
+        if c in self.defined_classes:
+            c += 'Reference'
+        elif c in self.enum_classes:
+            c += '._ctype_'
+        elif c_name.endswith('*'):
+            e = self.class4(c_name[:-1])
+            if e in self.enum_classes and c == 'ctypes.POINTER(%s)' % (e,):
+                c = 'ctypes.POINTER(%s._ctype_)' % (e,)
+        return c
 
     def convert_classnames(self, source):
         """Convert enum names to class names.
@@ -769,6 +807,8 @@ class _Generator(object):
                 self.generate_structs()
             elif genums and t.startswith('# GENERATED_WRAPPERS'):
                 self.generate_wrappers()
+            elif self.lazy and t.startswith('dll = _load_library()'):
+                self.output('dll = _LazyLibrary(_load_library)')
             elif t.startswith("build_date ="):
                 v, t = _NA_, self.parser.version
                 if t:
@@ -779,6 +819,14 @@ class _Generator(object):
                 self.output(t, nt=0)
         f.close()
 
+    def emit(self, name, text, nt=1):
+        """Output the code defining name, or keep it for the lazy index.
+        """
+        if self.lazy:
+            self.lazies.append((name, text))
+        else:
+            self.output(text, nt=nt)
+
     def outclose(self):
         """Close the output file.
         """
@@ -859,21 +907,21 @@ class PythonGenerator(_Generator):
 
         #'XnNeededNodeData': 'NeededNodeData',
         'XnNodeQuery*': 'NodeQuery',
-        'XnNodeQuery**': 'ctypes.POINTER(NodeQuery)',
+        'XnNodeQuery**': 'ctypes.POINTER(NodeQueryReference)',
 
         'XnEnumerationErrors*': 'EnumerationErrors',
-        'XnEnumerationErrors**': 'ctypes.POINTER(EnumerationErrors)',
+        'XnEnumerationErrors**': 'ctypes.POINTER(EnumerationErrorsReference)',
         'XnEnumerationErrorsIterator': 'EnumerationErrorsIterator',
 
         'XnProductionNodeType*': 'ctypes.POINTER(XnProductionNodeType)',
         'XnProductionNodeType': 'XnProductionNodeType',
-        'XnPixelFormat*': 'ctypes.POINTER(PixelFormat)',
+        'XnPixelFormat*': 'ctypes.POINTER(PixelFormat._ctype_)',
 
         'XnNodeHandle': 'NodeHandle',
-        'XnNodeHandle*': 'ctypes.POINTER(NodeHandle)',
+        'XnNodeHandle*': 'ctypes.POINTER(NodeHandleReference)',
 
-        'XnSkeletonJoint*': 'ctypes.POINTER(SkeletonJoint)',
-        'XnRecordMedium*': 'ctypes.POINTER(RecordMedium)',
+        'XnSkeletonJoint*': 'ctypes.POINTER(SkeletonJoint._ctype_)',
+        'XnRecordMedium*': 'ctypes.POINTER(RecordMedium._ctype_)',
 
         'XnPoseDetectionStatus*': 'ctypes.POINTER(XnPoseDetectionStatus)',
         'XnPoseDetectionStatus': 'XnPoseDetectionStatus',
@@ -940,11 +988,18 @@ class PythonGenerator(_Generator):
         'NodeInfo',
     )
 
-    def __init__(self, parser=None):
+    def __init__(self, parser=None, bind=False, lazy=False):
         """New instance.
 
         @param parser: a L{Parser} instance.
+        @param bind: bind C functions at import time, see L{generate_ctypes}.
+        @param lazy: create symbols on first access, see L{generate_lazy}.
         """
+        self.bind = bind
+        self.lazy = lazy
+        self.lazies = []        # (name, code) of lazy symbols
+        self.lazy_methods = []  # (class, method, code) of lazy methods
+
         # Load override definitions
         self.overrides = self.parse_override('override.py')
 
@@ -1001,6 +1056,16 @@ class PythonGenerator(_Generator):
 
     def generate_ctypes(self):
         """Generate a ctypes decorator for all functions.
+
+        By default, each function is a Python wrapper which creates
+        the ctypes prototype on first call, and replaces itself with
+        it.  In bind mode, the ctypes prototype is created at import
+        time.  Either way, calls then go straight to ctypes.
+
+        Functions with output parameters get a C{*_into} variant, which
+        takes all parameters, so that callers can reuse their output
+        objects or buffers instead of having ctypes allocate new ones
+        on each call.
         """
         self.output("""
  # Decorated C API functions #
@@ -1017,20 +1082,47 @@ class PythonGenerator(_Generator):
                 flags += ','
 
             # return value and arg classes
-            types = ', '.join([self.class4(f.type)] +  #PYCHOK flake
+            types = ', '.join([self.ref4(f.type)] +  #PYCHOK flake
                               [self.class4(p.type) for p in f.pars])
 
             # xformed doc string with first @param
             docs = self.epylink(f.epydocs(0, 4))  #PYCHOK flake
-            self.output("""def %(name)s(%(args)s):
+            self.generate_ctype(name, name, args, '(%s)' % flags, types, docs)
+
+            outs = f.outs()
+            if outs:
+                into = name + '_into'  #PYCHOK flake
+                args = ', '.join(p.name for p in f.pars)
+                docs = """Like %s, with caller-supplied output parameters %s,
+    filled in place: pass the same objects to each call.
+    @return: the C function result.""" % (name, ', '.join(outs))
+                self.generate_ctype(into, name, args, 'None', types, docs)
+
+    def generate_ctype(self, pyname, name, args, flags, types, docs):
+        """Generate the ctypes decorator for one function.
+
+        @param pyname: the Python function name.
+        @param name: the C function name.
+        @param flags: the ctypes parameter flags, None for all [in].
+        """
+        if self.bind or self.lazy:
+            self.emit(pyname, """%(pyname)s = _Cbind('%(name)s', %(flags)s, lambda: (
+                    %(types)s,))
+%(pyname)s.__doc__ = '''%(docs)s
+    '''
+""" % locals())
+            return
+
+        self.output("""def %(pyname)s(%(args)s):
     '''%(docs)s
     '''
-    f = _Cfunctions.get('%(name)s', None) or \\
-        _Cfunction('%(name)s', (%(flags)s),
+    global %(pyname)s
+    f = _Cfunctions.get('%(pyname)s', None) or \\
+        _Cfunction('%(name)s', %(flags)s,
                     %(types)s)
-    if not __debug__:  # i.e. python -O or -OO
-        global %(name)s
-        %(name)s = f
+    # bind the prototype, for direct calls from now on
+    f.__doc__ = %(pyname)s.__doc__
+    %(pyname)s = f
     return f(%(args)s)
 """ % locals())
 
@@ -1046,85 +1138,180 @@ class PythonGenerator(_Generator):
         for f in self.parser.callbacks:
             name = self.class4(f.name)  #PYCHOK flake
             docs = self.epylink(f.docs)
-            self.output('''class %(name)s(ctypes.c_void_p):
+            self.emit(name, '''class %(name)s(ctypes.c_void_p):
     """%(docs)s
     """
     pass''' % locals())
 
-        self.output("class CallbackDecorators(object):")
-        self.output('    "Class holding various method decorators for callback functions."')
+        t = ["class CallbackDecorators(object):",
+             '    "Class holding various method decorators for callback functions."']
         for f in self.parser.callbacks:
             name = self.class4(f.name)  #PYCHOK flake
 
-            # return value and arg classes
+            # return value and arg classes, arguments are built by ctypes
             types = ', '.join([self.class4(f.type)] +  #PYCHOK flake
-                              [self.class4(p.type) for p in f.pars])
+                              [self.ref4(p.type) for p in f.pars])
 
             # xformed doc string with first @param
             docs = self.epylink(f.docs)
 
-            self.output("""    %(name)s = ctypes.CFUNCTYPE(%(types)s)
+            t.append("""    %(name)s = ctypes.CFUNCTYPE(%(types)s)
     %(name)s.__doc__ = '''%(docs)s
     '''""" % locals())
-        self.output("cb = CallbackDecorators")
+        self.emit('CallbackDecorators', _NL_.join(t))
+        self.emit('cb', "cb = CallbackDecorators")
 
     def generate_enums(self):
         """Generate classes for all enum types.
         """
         self.output("""
-class _Enum(ctypes.c_ulong):
-    '''(INTERNAL) Base class
+class _Enum(int):
+    '''(INTERNAL) Base class of the enums, like IntEnum.
+
+    The members are interned int instances, compared as ints.  Each
+    enum has a _ctype_, which ctypes returns as the enum member.
     '''
-    _enum_names_ = {}
+    __slots__ = ()
+    _enum_names_ = {}  # value: name
+    _members_ = {}     # value: member
+
+    def __new__(cls, value=0):
+        try:
+            return cls._members_[value]
+        except (KeyError, TypeError):  # other value or ctypes instance
+            value = getattr(value, 'value', value)
+            m = cls._members_.get(value, None)
+            if m is None:
+                m = int.__new__(cls, value)
+                if value in cls._enum_names_:
+                    m = cls._members_.setdefault(value, m)
+            return m
 
     def __str__(self):
-        n = self._enum_names_.get(self.value, '') or ('FIXME_(%r)' % (self.value,))
+        n = self._enum_names_.get(self, '') or ('FIXME_(%r)' % (int(self),))
         return '.'.join((self.__class__.__name__, n))
 
     def __repr__(self):
         return '.'.join((self.__class__.__module__, self.__str__()))
 
+    @property
+    def name(self):
+        return self._enum_names_.get(self, None)
+
+    @property
+    def value(self):
+        return int(self)
+
+    @classmethod
+    def from_param(cls, value):
+        '''(INTERNAL) ctypes parameter conversion method.
+        '''
+        return int(value)
+
+    @classmethod
+    def _table(cls):
+        '''(INTERNAL) Return the sorted values, names and members arrays.
+        '''
+        t = cls.__dict__.get('_table_', None)
+        if t is None:
+            v = sorted(cls._enum_names_)
+            t = (numpy.array(v or [0]),
+                 numpy.array([cls._enum_names_[i] for i in v] + ['']),
+                 numpy.array([cls(i) for i in v] + [None], dtype=object))
+            cls._table_ = t
+        return t
+
+    @classmethod
+    def _index(cls, codes):
+        '''(INTERNAL) Return the table index of each code, the last one if unknown.
+        '''
+        v, _, _ = cls._table()
+        codes = numpy.asarray(codes)
+        i = numpy.searchsorted(v, codes).clip(0, len(v) - 1)
+        return numpy.where(v[i] == codes, i, len(cls._enum_names_))
+
+    @classmethod
+    def names(cls, codes):
+        '''Return the array of the names of an array of values, '' if unknown.
+        '''
+        return cls._table()[1][cls._index(codes)]
+
+    @classmethod
+    def decode(cls, codes):
+        '''Return the object array of the members of an array of values,
+        None if unknown.
+        '''
+        return cls._table()[2][cls._index(codes)]
+
+class _Cenum(ctypes.c_int):
+    '''(INTERNAL) Base class of the enum _ctype_, for results, struct
+    fields and callback arguments.  ctypes only converts results and
+    output parameters to the enum: struct fields and callback arguments
+    are _Cenum instances, which compare, hash and convert as the enum.
+    '''
+    _enum_ = int
+
+    def _check_retval_(self):
+        return self._enum_(self.value)
+    __ctypes_from_outparam__ = _check_retval_
+
     def __eq__(self, other):
-        return ( (isinstance(other, _Enum) and self.value == other.value)
-              or (isinstance(other, _Ints) and self.value == other) )
+        return self._enum_(self.value) == other
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        return self._enum_(self.value) != other
+
+    def __hash__(self):
+        return hash(self._enum_(self.value))
+
+    def __int__(self):
+        return int(self._enum_(self.value))
+
+    def __index__(self):
+        return self._enum_(self.value).__index__()
 """)
         for e in self.parser.enums:
 
             cls = self.class4(e.name)
-            self.output("""class %s(_Enum):
+            c = ["""class %s(_Enum):
     '''%s
     '''
-    _enum_names_ = {""" % (cls, e.epydocs() or _NA_))
+    _members_ = {}
+    _enum_names_ = {""" % (cls, e.epydocs() or _NA_)]
 
             for v in e.vals:
-                self.output("        %s: '%s'," % (v.value, v.name))
-            self.output('    }')
+                c.append("        %s: '%s'," % (v.value, v.name))
+            c.append('    }')
 
             # align on '=' signs
             w = -max(len(v.name) for v in e.vals)
             t = ['%s.%*s = %s(%s)' % (cls, w,v.name, cls, v.value) for v in e.vals]
+            t = sorted(t) + ["%s._ctype_ = type('%s', (_Cenum,), {'_enum_': %s})" % (cls, cls, cls)]
 
-            self.output(_NL_.join(sorted(t)), nt=2)
+            self.emit(cls, _NL_.join(c + t), nt=2)
 
     def generate_structs(self):
-        """Generate classes for all structs types.
+        """Generate classes for all structs types, see _Cstruct for
+        their numpy dtype.
         """
         for e in self.parser.structs:
             cls = self.class4(e.name)
             if cls in self.overrides[1]:
                 continue
-            self.output("""class %s(ctypes.Structure):
+            c = ["""class %s(_Cstruct):
     '''%s
     '''
-    _fields_ = (""" % (cls, e.epydocs() or _NA_))
+    _fields_ = (""" % (cls, e.epydocs() or _NA_)]
 
             for v in e.fields:
-                self.output("        ('%s', %s)," % (v.name, self.class4(v.type).replace('Context', 'ContextReference').replace('NodeHandle', 'NodeHandleReference')))
-            self.output('    )')
-            self.output('')
+                if v.length:  # array, not a pointer
+                    t = '%s * %s' % (self.ref4(v.type[:-1]),
+                                     self.parser.defines.get(v.length, v.length))
+                else:
+                    t = self.ref4(v.type)
+                c.append("        ('%s', %s)," % (v.name, t))
+            c.append('    )')
+            self.emit(cls, _NL_.join(c), nt=2)
 
     def generate_privates(self):
         """Generate classes for private objects.
@@ -1176,6 +1363,9 @@ class _Enum(ctypes.c_ulong):
     '''""" % (cls, docstrs.get(cls, '') or _NA_))
 
                 c = codes.get(cls, '')
+                if not '__slots__' in c:
+                    self.output("""
+    __slots__ = ()  # no instance __dict__, see _Ctype""")
                 if not 'def __new__' in c:
                     self.output("""
     def __new__(cls, ptr=None):
@@ -1201,6 +1391,14 @@ class _Enum(ctypes.c_ulong):
             if meth in methods.get(cls, []):
                 continue  # overridden
 
+            def output(meth, code):
+                if self.lazy:
+                    # dedent, the method is created outside of its class
+                    code = _NL_.join(t[4:] for t in code.splitlines())
+                    self.lazy_methods.append((cls, meth, code))
+                else:
+                    self.output(code)
+
             # arg names, excluding output args
             # and rename first arg to 'self'
             args = ', '.join(['self'] + f.args(1))  #PYCHOK flake
@@ -1214,28 +1412,66 @@ class _Enum(ctypes.c_ulong):
             # FIXME: more generic ??
             #outparams = [ p for p in f.pars if p.isOut() ]
 
-            # Hackish way to handle an opaque type (XnNodeHandle is an
-            # opaque ctypes.POINTER(ctypes.c_void_p)).  Works for now,
-            # something better should clearly be found: a list of
-            # wrapped opaque types should be defined, and converted
-            # through ctypes errcheck?
-            references = [ self.class4(p.type) for p in f.pars if 'Reference' in self.class4(p.type) ]
-            #print "REFERENCES", f.name, references
-            if len(references) == 1:
-                # We can convert to the appropriate type
-                ref = re.findall('ctypes.POINTER\((.+)Reference\)', references[0])[0]
-                self.output("""    def %(meth)s(%(args)s):
+            # Opaque handles returned by ctypes, as result or [out]
+            # parameter, are converted to their wrapper class by their
+            # reference class (see _Reference in header.py), and the
+            # C function is the bound prototype after its first call:
+            # the method calls straight into ctypes.
+            output(meth, """    def %(meth)s(%(args)s):
         '''%(docs)s
         '''
-        return %(ref)s(%(name)s(%(args)s))
+        return %(name)s(%(args)s)
 """ % locals())
-            else:
-                self.output("""    def %(meth)s(%(args)s):
-        '''%(docs)s
+
+            outs = f.outs()
+            if outs and meth + '_into' not in methods.get(cls, []):
+                meth += '_into'
+                args = ', '.join(['self'] + [p.name for p in f.pars[1:]])
+                outs = ', '.join(outs)
+                output(meth, """    def %(meth)s(%(args)s):
+        '''Like %(name)s, with caller-supplied output parameters %(outs)s,
+        filled in place: pass the same objects to each call.
+        @return: the C function result.
         '''
-        return %(name)s(%(args)s)
+        return %(name)s_into(%(args)s)
 """ % locals())
 
+    def generate_lazy(self):
+        """Generate the index of lazily created symbols and methods.
+
+        In lazy mode, the enum and struct classes, the C functions and
+        the callback types are only created on first access, through
+        the module C{__getattr__} (Python 3.7+), and the generated
+        wrapper methods through C{_Ctype.__getattr__}.  The index maps
+        each name to its code and to the lazy names the code refers
+        to.  The lazy names used by the hand-written code of header.py,
+        override.py and footer.py are created at import time.
+        """
+        names = set(n for n, _ in self.lazies)
+
+        def deps(name, code):
+            return tuple(sorted(set(ident_re.findall(code)) & names - set([name])))
+
+        self.output("""
+ # Index of lazily created symbols #
+""")
+        self.output('_lazy.update({')
+        for n, code in self.lazies:
+            self.output('    %r: (%r, %r),' % (n, code, deps(n, code)))
+        self.output('})')
+        self.output('_lazy_methods.update({')
+        for c, m, code in self.lazy_methods:
+            self.output('    %r: (%r, %r),' % ((c, m), code, deps(m, code)))
+        self.output('})')
+
+        used = set()
+        for source in ('header.py', 'override.py', 'footer.py'):
+            f = opener(source)
+            used.update(ident_re.findall(f.read()))
+            f.close()
+        self.output('for _n in %r:' % (tuple(sorted(used & names)),))
+        self.output('    _materialize(_n)', nt=2)
+
     def parse_override(self, override):
         """Parse the override definitions file.
 
@@ -1284,17 +1520,19 @@ class _Enum(ctypes.c_ulong):
         #self.generate_wrappers()
         self.generate_ctypes()
         self.generate_callbacks()
+        if self.lazy:
+            self.generate_lazy()
 
         self.unwrapped()
 
         self.insert_code('footer.py')
         self.outclose()
 
-def process(output, h_files):
+def process(output, h_files, bind=False, lazy=False):
     """Generate Python bindings.
     """
     p = Parser(h_files)
-    g = PythonGenerator(p)
+    g = PythonGenerator(p, bind, lazy)
     g.save(output)
 
 
@@ -1306,6 +1544,10 @@ if __name__ == '__main__':
 
 Parse include files and generate bindings code for Python.""")
 
+    opt.add_option('-b', '--bind', dest='bind', action='store_true',
+                   default=False,
+                   help='Bind C functions at import time, for faster calls')
+
     opt.add_option('-c', '--check', dest='check', action='store_true',
                    default=False,
                    help='Check mode, generates no bindings')
@@ -1318,6 +1560,10 @@ Parse include files and generate bindings code for Python.""")
                    default=False,
                    help='Dump structure definitions')
 
+    opt.add_option('-l', '--lazy', dest='lazy', action='store_true',
+                   default=False,
+                   help='Create symbols on first access, for faster imports (Python 3.7+)')
+
     opt.add_option('-o', '--output', dest='output', action='store', type='str',
                    default='-',
                    help='Output filename (for Python) or directory (for Java)')
@@ -1369,10 +1615,11 @@ Parse include files and generate bindings code for Python.""")
         #    print n, "\t", o
 
     else:
-        g = PythonGenerator(p)
+        g = PythonGenerator(p, opts.bind, opts.lazy)
         if opts.debug:
             g.dump_dicts()
         elif opts.structs:
+            g.lazy = False  # plain dump
             g.outopen(opts.output)
             g.output('import ctypes')
             g.generate_enums()
@@ -23,56 +23,139 @@
 """This module provides bindings for the OpenNI C API.
 """
 
+import collections
+import contextlib
 import ctypes
+import os
 import sys
+import threading
+import time
+import weakref
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, see MapView.array
+    numpy = None
 
 build_date  = ''  # build time stamp and __version__, see generate.py
 
  # Used on win32 and MacOS in override.py
 plugin_path = None
 
-if sys.platform.startswith('linux'):
-    dll = ctypes.CDLL('libOpenNI.so')
+def _load_library():
+    """(INTERNAL) Load the OpenNI library, or the library named by the
+    NI_LIBRARY environment variable, e.g. the simulated libOpenNIsim.so
+    built by make sim.
+    """
+    p = os.environ.get('NI_LIBRARY', None)
+    if p:
+        return ctypes.CDLL(p)
+
+    if sys.platform.startswith('linux'):
+        return ctypes.CDLL('libOpenNI.so')
+
+    elif sys.platform.startswith('win'):
+        import ctypes.util as u
+        n = 'OpenNI64' if sys.maxsize > 2**32 else 'OpenNI'
+        p = u.find_library(n)
+        if p is None:
+            return ctypes.CDLL(n + '.dll')
+        else:
+            return ctypes.CDLL(p)
+
+    elif sys.platform.startswith('darwin'):
+        return ctypes.CDLL('libOpenNI.dylib')
 
-elif sys.platform.startswith('win'):
-    import ctypes.util as u
-    p = u.find_library('libopenni.dll')
-    if p is None:
-        dll = ctypes.CDLL('libvlc.dll')
     else:
-        dll = ctypes.CDLL(p)
-    del p
+        raise NotImplementedError('%s: %s not supported' % (sys.argv[0], sys.platform))
 
-elif sys.platform.startswith('darwin'):
-    dll = ctypes.CDLL('libOpenNI.dylib')
+class _LazyLibrary(object):
+    """(INTERNAL) Library loaded on first use, see generate.py -l.
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._dll = None
+
+    def __getattr__(self, name):
+        if self._dll is None:
+            self._dll = self._loader()
+        return getattr(self._dll, name)
 
-else:
-    raise NotImplementedError('%s: %s not supported' % (sys.argv[0], sys.platform))
+dll = _load_library()
 
 try:
     _Ints = (int, long)
 except NameError:  # no long in Python 3+
     _Ints =  int
 
+try:
+    _Strs = basestring
+except NameError:  # no basestring in Python 3+
+    _Strs = (str, bytes)
+
 _Seqs = (list, tuple)
 
+try:
+    _StopAsync = StopAsyncIteration
+except NameError:  # no async iterators before Python 3.5
+    _StopAsync = StopIteration
+
 _Cfunctions = {}  # from LibVLC __version__
 
 def _Cfunction(name, flags, *types):
     """(INTERNAL) New ctypes function binding.
+
+    Without flags, i.e. without output parameter handling, this is the
+    binding of the generated name + '_into' function.
     """
     if hasattr(dll, name):
         p = ctypes.CFUNCTYPE(*types)
-        f = p((name, dll), flags)
+        if flags is None:
+            f = p((name, dll))
+            name += '_into'
+        else:
+            f = p((name, dll), flags)
         _Cfunctions[name] = f
         return f
     raise NameError('no function %r' % (name,))
 
+def _Cbind(name, flags, types):
+    """(INTERNAL) ctypes function bound at import time, see generate.py -b.
+
+    The types are given as a function returning the ctypes types, so
+    that unavailable or unusable functions only raise when called, as
+    the lazily bound ones do.
+    """
+    try:
+        return _Cfunction(name, flags, *types())
+    except (NameError, TypeError) as e:
+        err = e
+        def f(*args):
+            raise err
+        f.__name__ = name
+        return f
+
+# Wrappers by (class, pointer value), see _Cobject
+_Cobjects = weakref.WeakValueDictionary()
+
 def _Cobject(cls, ctype):
-    """(INTERNAL) New instance from ctypes.
+    """(INTERNAL) Instance from ctypes.
+
+    Instances are interned: the same class and pointer give the same
+    instance, as long as it is referenced.
     """
-    o = object.__new__(cls)
-    o._as_parameter_ = ctype
+    v = ctype.value
+    if v is None:  # NULL
+        o = object.__new__(cls)
+        o._as_parameter_ = ctype
+        return o
+    k = (cls, v)
+    o = _Cobjects.get(k, None)
+    if o is None:
+        o = object.__new__(cls)
+        # own copy, the caller may reuse ctype
+        o._as_parameter_ = ctypes.c_void_p(v)
+        o = _Cobjects.setdefault(k, o)
     return o
 
 def _Constructor(cls, ptr):
@@ -80,21 +163,253 @@ def _Constructor(cls, ptr):
     """
     if ptr is None:
         raise Exception('(INTERNAL) ctypes class.')
-    if ptr == 0:
-        return None
     if not isinstance(ptr, ctypes.c_void_p):
-        ptr = ctypes.c_void_p
+        ptr = ctypes.c_void_p(ptr)
+    if not ptr.value:
+        return None
     return _Cobject(cls, ptr)
 
+def _printError(status, what):
+    """(INTERNAL) Report status with xnPrintError, what being a str or
+    bytes, which Python 3 ctypes needs for the C string.
+    """
+    if not isinstance(what, bytes):
+        what = what.encode('utf-8')
+    xnPrintError(status, what)
+
+# Property change callbacks by node pointer value, see NodeHandle._properties
+_PropertyWatches = {}  # value: [(unregister function, callback handle, callback)]
+
+def _unwatchProperties(v):
+    """(INTERNAL) Unregister the property change callbacks of node v.
+    """
+    for u, h, _ in _PropertyWatches.pop(v, ()):
+        u(ctypes.c_void_p(v), h)
+
+# Nodes with cached queries by context and name, see NodeHandle._newCache:
+# a node created later at the same address must not inherit them
+_NodeNames = {}  # context pointer value, None if unknown: {node name: set of pointer values}
+_NodeWatches = {}  # context pointer value: (callback handle, callback)
+
+def _nodeContext(node):
+    """(INTERNAL) Return the pointer value of the context of node, None
+    if unknown.
+    """
+    p = ctypes.c_void_p()
+    try:
+        if dll.xnGetRefContextFromNodeHandle(node, ctypes.byref(p)):
+            return None
+    except AttributeError:  # before OpenNI 1.1
+        return None
+    dll.xnContextRelease(p)
+    return p.value
+
+def _dropNodes(v, name=None):
+    """(INTERNAL) Drop the cached queries and properties of the nodes of
+    context v, only those named name if given, and of the nodes of an
+    unknown context.
+    """
+    for k in (v, None):
+        names = _NodeNames.get(k, None)
+        if not names:
+            continue
+        if name is None:
+            del _NodeNames[k]
+            t = names.values()
+        else:
+            t = [names.pop(name, ())]
+        for nodes in t:
+            for n in nodes:
+                _unwatchProperties(n)
+                o = _Cobjects.get((NodeHandle, n), None)
+                if o is not None:
+                    o._dropCache()
+
+def _watchNodes(context):
+    """(INTERNAL) Drop the cached queries and properties of the nodes
+    destroyed in context, registered once per context.  Return context.
+    """
+    v = context._as_parameter_.value
+    if v in _NodeWatches:
+        return context
+    def destroyed(pContext, strDestroyedNodeName, pCookie):
+        _dropNodes(v, strDestroyedNodeName)
+    f = cb.NodeDestructionHandler(destroyed)
+    h = ctypes.c_void_p()
+    status = dll.xnRegisterToNodeDestruction(context, f, None, ctypes.byref(h))
+    if status:
+        _printError(status, "Node destruction callback")
+    else:
+        _NodeWatches[v] = (h, f)
+    return context
+
+def _unwatchNodes(context):
+    """(INTERNAL) Unregister the node destruction callback of context.
+    """
+    t = _NodeWatches.pop(context._as_parameter_.value, None)
+    if t is not None:
+        dll.xnUnregisterFromNodeDestruction(context, t[0])
+
+# Owned native objects, see _Cown
+_Cfinalizers = {}  # (class, pointer value): (weakref, free function)
+
+def _Cown(o, free):
+    """(INTERNAL) Own the native object of wrapper o: free it when o
+    is garbage collected, unless freed before by _Cfree.
+    """
+    k = (type(o), o._as_parameter_.value)
+    def collected(r):
+        f = _Cfinalizers.get(k, None)
+        if f is not None and f[0] is r:
+            del _Cfinalizers[k]
+            f[1](ctypes.c_void_p(k[1]))
+    _Cfinalizers[k] = (weakref.ref(o, collected), free)
+    return o
+
+def _Cfree(o, free):
+    """(INTERNAL) Free the native object of wrapper o now, and detach
+    o from it: o is NULL afterwards, and freeing it again does nothing.
+    """
+    v = o._as_parameter_.value
+    if v:
+        k = (type(o), v)
+        _Cfinalizers.pop(k, None)
+        _Cobjects.pop(k, None)
+        o._as_parameter_ = ctypes.c_void_p()
+        free(ctypes.c_void_p(v))
+
+# Lazily created symbols and wrapper methods, see generate.py -l
+_lazy = {}          # name: (code, names used by the code)
+_lazy_methods = {}  # (class name, method name): (code, names)
+_lazy_lock = threading.RLock()
+
+def _materialize(name):
+    """(INTERNAL) Create the lazy symbol name, and the ones it uses.
+    """
+    g = globals()
+    with _lazy_lock:
+        if name not in g:
+            code, names = _lazy.pop(name)
+            for n in names:
+                if n in _lazy:
+                    _materialize(n)
+            exec(code, g)
+    return g[name]
+
+def __getattr__(name):
+    """Create lazy symbols on first access (Python 3.7+).
+    """
+    if name in _lazy:
+        return _materialize(name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
+
 class _Ctype(object):
     """(INTERNAL) Base class for ctypes.
+
+    Instances only hold their pointer: subclasses define empty
+    __slots__, so that they have no instance __dict__.
     """
+    __slots__ = ('_as_parameter_', '__weakref__')
+
     @staticmethod
     def from_param(this):  # not self
         """(INTERNAL) ctypes parameter conversion method.
         """
         return this._as_parameter_
 
+    def __getattr__(self, name):
+        """(INTERNAL) Create lazy wrapper methods on first access.
+        """
+        for c in type(self).__mro__:
+            k = (c.__name__, name)
+            if k in _lazy_methods:
+                with _lazy_lock:
+                    if k in _lazy_methods:
+                        code, names = _lazy_methods.pop(k)
+                        for n in names:
+                            if n in _lazy:
+                                _materialize(n)
+                        d = {}
+                        exec(code, globals(), d)
+                        setattr(c, name, d[name])
+                return getattr(self, name)
+        raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
+
+# Map buffers returned by xnGet*Map are only valid until the next
+# wait*UpdateAll call, which bumps this serial (see Context in override.py)
+_update_serial = 0
+
+def _expire_views():
+    """(INTERNAL) Mark all current MapView instances as stale.
+    """
+    global _update_serial
+    _update_serial += 1
+
+class MapView(object):
+    """Zero-copy, read-only view on a generator map buffer.
+
+    The memory belongs to OpenNI and is only valid until the next
+    wait*UpdateAll call on the context.  After that, accessing the
+    view raises a ValueError: use copy() to keep a frame longer.
+    """
+    def __init__(self, ptr, ctype, shape, owned=False):
+        n = 1
+        for d in shape:
+            n *= d
+        self.ctype = ctype
+        self.shape = tuple(shape)
+        if owned:
+            self._buffer = (ctype * n).from_buffer_copy(ptr)
+            self._serial = None
+        else:
+            self._buffer = ctypes.cast(ptr, ctypes.POINTER(ctype * n)).contents
+            self._serial = _update_serial
+        self._array = None
+        self.frameID = 0
+        self.timestamp = 0
+
+    def isValid(self):
+        """Return True if the underlying buffer can still be read.
+        """
+        return self._serial is None or self._serial == _update_serial
+
+    def _check(self):
+        if not self.isValid():
+            raise ValueError('stale map view, use copy() to keep frames')
+
+    @property
+    def buffer(self):
+        """The ctypes array on the map memory (no copy).
+        """
+        self._check()
+        return self._buffer
+
+    @property
+    def array(self):
+        """The read-only numpy array on the map memory (no copy).
+        """
+        self._check()
+        if self._array is None:
+            if numpy is None:
+                raise ImportError('numpy is required for MapView.array')
+            a = numpy.frombuffer(self._buffer, dtype=numpy.dtype(self.ctype))
+            a = a.reshape(self.shape)
+            a.flags.writeable = False
+            self._array = a
+        return self._array
+
+    def copy(self):
+        """Return a MapView owning a copy of the data, valid forever.
+        """
+        self._check()
+        v = MapView(self._buffer, self.ctype, self.shape, owned=True)
+        v.frameID = self.frameID
+        v.timestamp = self.timestamp
+        return v
+
 class ListPOINTER(object):
     """Just like a POINTER but accept a list of ctype as an argument.
     """
@@ -105,24 +420,110 @@ class ListPOINTER(object):
         if isinstance(param, _Seqs):
             return (self.etype * len(param))(*param)
 
+def _dtype(ctype):
+    """(INTERNAL) The numpy dtype with the layout of a ctypes type.
+    """
+    if issubclass(ctype, ctypes.Structure):
+        names = [f[0] for f in ctype._fields_]
+        return numpy.dtype({'names': names,
+                            'formats': [_dtype(f[1]) for f in ctype._fields_],
+                            'offsets': [getattr(ctype, n).offset for n in names],
+                            'itemsize': ctypes.sizeof(ctype)})
+    if issubclass(ctype, ctypes.Array):
+        return numpy.dtype((_dtype(ctype._type_), ctype._length_))
+    t = ctype._type_
+    if not isinstance(t, str) or t in 'PzZ':  # pointers
+        return numpy.dtype(numpy.uintp)
+    return numpy.dtype(t)
+
+class _Dtype(object):
+    """(INTERNAL) Class attribute with the numpy dtype of a struct,
+    built on first access.
+    """
+    def __get__(self, obj, cls):
+        if numpy is None:
+            raise ImportError('numpy is required for %s.dtype' % (cls.__name__,))
+        d = _dtype(cls)
+        cls.dtype = d
+        return d
+
+class _Cstruct(ctypes.Structure):
+    """(INTERNAL) Base class for the generated structs.
+
+    The dtype class attribute is the numpy dtype with the same fields
+    and offsets, so arrays of structs can be processed with numpy.
+    """
+    dtype = _Dtype()
+
+    @classmethod
+    def records(cls, array):
+        """View a ctypes array of this struct (or any buffer of them)
+        as a numpy record array, without copy.
+        """
+        return numpy.frombuffer(array, dtype=cls.dtype).view(numpy.recarray)
+
+    @classmethod
+    def fromRecords(cls, records):
+        """View a contiguous numpy array of this struct dtype as a
+        ctypes array, without copy, e.g. to pass it to a function.
+        """
+        if records.dtype != cls.dtype:
+            raise TypeError('expected dtype %r, not %r' % (cls.dtype, records.dtype))
+        return (cls * len(records)).from_buffer(records)
+
+class NodeInfos(tuple):
+    """The NodeInfo entries of a NodeInfoList, see NodeInfoList.infos().
+
+    The entries belong to the list, which is kept alive as attribute
+    list.
+    """
+    def __new__(cls, infos, owner):
+        t = tuple.__new__(cls, infos)
+        t.list = owner
+        return t
+
 class EnumerationErrorsIterator(ctypes.c_void_p):
     pass
 
 class FPSData(ctypes.c_void_p):
     pass
 
-class NodeHandleReference(ctypes.c_void_p):
+class _Reference(ctypes.c_void_p):
+    """(INTERNAL) Base class for opaque handles built by ctypes.
+
+    ctypes converts them to their wrapper class, or None if NULL, when
+    they are a function result (_check_retval_) or an [out] parameter
+    (__ctypes_from_outparam__).
+    """
+    def _check_retval_(self):
+        if self.value:
+            return self.dereference()
+    __ctypes_from_outparam__ = _check_retval_
+
+class NodeHandleReference(_Reference):
     def dereference(self):
         return NodeHandle(self)
 
-class ContextReference(ctypes.c_void_p):
+class ContextReference(_Reference):
     def dereference(self):
         return Context(self)
 
-class NodeInfoListReference(ctypes.c_void_p):
+class NodeInfoListReference(_Reference):
     def dereference(self):
         return NodeInfoList(self)
 
+class NodeInfoReference(_Reference):
+    def dereference(self):
+        return NodeInfo(self)
+
+class NodeQueryReference(_Reference):
+    def dereference(self):
+        return NodeQuery(self)
+
+class EnumerationErrorsReference(_Reference):
+    def dereference(self):
+        return EnumerationErrors(self)
+
 class NodeInfoListNode(ctypes.c_void_p):
     pass
 
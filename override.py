@@ -7,68 +7,496 @@ class Context(_Ctype):
             if i == 0:
                 return None
             if isinstance(i, _Ints):
-                return _Cobject(cls, ctypes.c_void_p(i))
-            elif isinstance(i, basestring):
+                return _watchNodes(_Cobject(cls, ctypes.c_void_p(i)))
+            elif isinstance(i, ctypes.c_void_p):
+                return _watchNodes(_Cobject(cls, i))
+            elif isinstance(i, _Strs):
                 # Init from XML file
                 p = ctypes.c_void_p()
                 err = EnumerationErrors()
                 status = dll.xnInitFromXmlFile(i, ctypes.byref(p), err)
                 if status:
-                    xnPrintError(status, "Context creation")
+                    _printError(status, "Context creation")
                     return None
         p = ctypes.c_void_p()
         status = dll.xnInit(ctypes.byref(p))
         if status:
-            xnPrintError(status, "Context creation")
+            _printError(status, "Context creation")
             return None
-        return _Cobject(cls, p)
+        return _watchNodes(_Cobject(cls, p))
+
+    def waitAndUpdateAll(self):
+        '''Wait for all generators to have new data, then update them.
+        Map views obtained before the call become stale.
+        '''
+        _expire_views()
+        return xnWaitAndUpdateAll(self)
+
+    def waitAnyUpdateAll(self):
+        '''Wait for any generator to have new data, then update all of them.
+        Map views obtained before the call become stale.
+        '''
+        _expire_views()
+        return xnWaitAnyUpdateAll(self)
+
+    def waitOneUpdateAll(self, hNode):
+        '''Wait for hNode to have new data, then update all generators.
+        Map views obtained before the call become stale.
+        '''
+        _expire_views()
+        return xnWaitOneUpdateAll(self, hNode)
+
+    def waitNoneUpdateAll(self):
+        '''Update all generators without waiting for new data.
+        Map views obtained before the call become stale.
+        '''
+        _expire_views()
+        return xnWaitNoneUpdateAll(self)
+
+    def waitAndUpdateFrames(self, sync):
+        '''Wait for all generators to have new data, update them and
+        return the FrameBundle taken by the FrameSync sync.
+        '''
+        status = self.waitAndUpdateAll()
+        if status:
+            _printError(status, "Frame update")
+            return None
+        return sync.snapshot()
+
+    def frames(self, nodes, snapshot=None, any=False, loop=None):
+        '''Return an AsyncFrames iterator over the updates of nodes:
+
+            async for frame in context.frames([depth], snapshot=...):
+                ...
+        '''
+        return AsyncFrames(self, nodes, snapshot, any, loop)
+
+    def waitAndUpdateAllAsync(self, nodes, loop=None):
+        '''Return a future of the update status, set when all nodes
+        have new data and the context has been updated.
+        '''
+        return AsyncFrames(self, nodes, loop=loop).once()
+
+    def waitAnyUpdateAllAsync(self, nodes, loop=None):
+        '''Return a future of the update status, set when any of nodes
+        has new data and the context has been updated.
+        '''
+        return AsyncFrames(self, nodes, any=True, loop=loop).once()
+
+    def release(self):
+        '''Release a context, and drop the cached queries and properties
+        of its nodes, see NodeHandle.isCapabilitySupported().
+        '''
+        _dropNodes(self._as_parameter_.value)
+        _unwatchNodes(self)
+        xnContextRelease(self)
+
+class NodeHandle(_Ctype):
+    """Production node handle.
+    """
+    __slots__ = ('_cache',)  # see _cached
+
+    def _mapView(self, ptr, ctype, planes=1):
+        '''(INTERNAL) Return a MapView on ptr, shaped from the map output mode.
+        '''
+        if not ptr:
+            return None
+        m = MapOutputMode()
+        status = dll.xnGetMapOutputMode(self, ctypes.byref(m))
+        if status:
+            _printError(status, "Map output mode")
+            return None
+        shape = (int(m.nYRes), int(m.nXRes))
+        if planes > 1:
+            shape += (planes,)
+        v = MapView(ptr, ctype, shape)
+        v.frameID = xnGetFrameID(self)
+        v.timestamp = xnGetTimestamp(self)
+        return v
+
+    def getDepthMapView(self):
+        '''Return a zero-copy, read-only MapView on the current depth map.
+
+        The view is shaped (nYRes, nXRes) and is only valid until
+        the next wait*UpdateAll call, see MapView.copy().
+        '''
+        return self._mapView(xnGetDepthMap(self), ctypes.c_uint16)
+
+    def getImageMapView(self):
+        '''Return a zero-copy, read-only MapView on the current image map.
+
+        The view is shaped (nYRes, nXRes, bytes per pixel), see
+        getDepthMapView().
+        '''
+        return self._mapView(xnGetImageMap(self), ctypes.c_uint8,
+                             xnGetBytesPerPixel(self))
+
+    def getIRMapView(self):
+        '''Return a zero-copy, read-only MapView on the current IR map.
+        '''
+        return self._mapView(xnGetIRMap(self), ctypes.c_uint16)
+
+    def getLabelMapView(self):
+        '''Return a zero-copy, read-only MapView on the current scene label map.
+        '''
+        return self._mapView(xnGetLabelMap(self), ctypes.c_uint16)
+
+    def _convertPoints(self, f, points, out, what):
+        '''(INTERNAL) Convert an (N, 3) array of points with f in one call.
+        '''
+        if numpy is None:
+            raise ImportError('numpy is required for %s' % (what,))
+        points = numpy.ascontiguousarray(points, dtype=numpy.float32)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('expected an (N, 3) array, not %r' % (points.shape,))
+        if out is None:
+            out = numpy.empty_like(points)
+        elif out.dtype != numpy.float32 or out.shape != points.shape or \
+             not (out.flags.c_contiguous and out.flags.writeable):
+            raise ValueError('expected a writeable, contiguous float32 %r array' % (points.shape,))
+        status = f(self, ctypes.c_uint32(len(points)),
+                   ctypes.c_void_p(points.ctypes.data), ctypes.c_void_p(out.ctypes.data))
+        if status:
+            _printError(status, what)
+            return None
+        return out
+
+    def projectiveToRealWorld(self, points, out=None):
+        '''Convert an (N, 3) float32 array of projective points to real
+        world coordinates, with a single xnConvertProjectiveToRealWorld call.
+
+        @param points: the (N, 3) points, other arrays are converted (copied).
+        @param out: optional, preallocated (N, 3) float32 result array,
+        which may be points itself, to convert in place.
+        @return: the (N, 3) float32 real world points, None on error.
+        '''
+        return self._convertPoints(dll.xnConvertProjectiveToRealWorld, points, out,
+                                   "Projective to real world conversion")
+
+    def realWorldToProjective(self, points, out=None):
+        '''Convert an (N, 3) float32 array of real world points to
+        projective coordinates, see projectiveToRealWorld().
+        '''
+        return self._convertPoints(dll.xnConvertRealWorldToProjective, points, out,
+                                   "Real world to projective conversion")
+
+    def getTrackedUsers(self):
+        '''Return the list of the users whose skeleton is tracked, None on error.
+        '''
+        n = xnGetNumberOfUsers(self)
+        a = (ctypes.c_uint32 * n)()
+        c = ctypes.c_uint16(n)
+        status = dll.xnGetUsers(self, a, ctypes.byref(c))
+        if status:
+            _printError(status, "Users")
+            return None
+        return [int(u) for u in a[:c.value] if xnIsSkeletonTracking(self, u)]
+
+    def getSkeletonJoints(self, users=None, joints=None, out=None):
+        '''Return the positions, orientations and confidences of the
+        skeleton joints of several users, in a single record array.
+
+        @param users: the user IDs, by default the tracked users.
+        @param joints: the SkeletonJoint values, by default all.
+        @param out: optional, preallocated (max users, joints) record array
+        with the SkeletonJointTransformation.dtype, for reuse across frames.
+        @return: (users, records), the records are a (users, joints) view
+        with fields position.position.X ... and orientation.orientation.elements,
+        zeros for the joints which are not available; None on error.
+        '''
+        if numpy is None:
+            raise ImportError('numpy is required for getSkeletonJoints')
+        if users is None:
+            users = self.getTrackedUsers()
+            if users is None:
+                return None
+        if joints is None:
+            joints = sorted(SkeletonJoint._enum_names_)
+        t = SkeletonJointTransformation
+        if out is None:
+            out = numpy.zeros((len(users), len(joints)), dtype=t.dtype)
+        elif out.dtype != t.dtype or out.ndim != 2 or out.shape[1] != len(joints) or \
+             out.shape[0] < len(users) or not out.flags.c_contiguous:
+            raise ValueError('expected a contiguous (>= %d, %d) array of %s.dtype' %
+                             (len(users), len(joints), t.__name__))
+        # one ctypes array on the records: xnGetSkeletonJoint writes in place
+        a = (t * out.size).from_buffer(out)
+        f, n, i = xnGetSkeletonJoint_into, ctypes.sizeof(t), 0
+        for u in users:
+            for j in joints:
+                if f(self, u, j, a[i]):  # not available
+                    ctypes.memset(ctypes.addressof(a) + i * n, 0, n)
+                i += 1
+        return users, out[:len(users)].view(numpy.recarray)
+
+    def _newCache(self):
+        '''(INTERNAL) Return a new, empty cache of the node, dropped
+        when the node is destroyed or its context released, see
+        _watchNodes.
+        '''
+        c = self._cache = {}
+        names = _NodeNames.setdefault(_nodeContext(self), {})
+        names.setdefault(xnGetNodeName(self), set()).add(self._as_parameter_.value)
+        return c
+
+    def _dropCache(self):
+        '''(INTERNAL) Drop the cached queries and properties of the node.
+        '''
+        try:
+            del self._cache
+        except AttributeError:
+            pass
+
+    def _cached(self, key, query, *args):
+        '''(INTERNAL) Return query(self, *args), memoized for this node
+        until its release(), by key and args.
+        '''
+        try:
+            c = self._cache
+        except AttributeError:
+            c = self._newCache()
+        k = (key,) + args
+        try:
+            return c[k]
+        except KeyError:
+            v = c[k] = query(self, *args)
+            return v
+
+    def isCapabilitySupported(self, strCapabilityName):
+        '''Checks if a production node supports a specific capability.
+        The answer is cached until the node is released.
+        '''
+        try:  # inlined _cached, used in hot paths
+            return self._cache['capability', strCapabilityName]
+        except (AttributeError, KeyError):
+            return self._cached('capability', xnIsCapabilitySupported, strCapabilityName)
+
+    def isPixelFormatSupported(self, Format):
+        '''Checks if a specific pixel format is supported.
+        The answer is cached until the node is released.
+        '''
+        return self._cached('pixel format', xnIsPixelFormatSupported, Format)
+
+    def getSupportedMapOutputModesCount(self):
+        '''Gets the number of supported map output modes.
+        The answer is cached until the node is released.
+        '''
+        return self._cached('modes count', xnGetSupportedMapOutputModesCount)
+
+    def getSupportedMapOutputModes(self):
+        '''Return the tuple of supported MapOutputMode, None on error.
+        The answer is cached until the node is released.
+        '''
+        return self._cached('modes', NodeHandle._supportedMapOutputModes)
+
+    def _supportedMapOutputModes(self):
+        '''(INTERNAL) Query the supported map output modes.
+        '''
+        n = self.getSupportedMapOutputModesCount()
+        a = (MapOutputMode * n)()
+        c = ctypes.c_uint32(n)
+        status = dll.xnGetSupportedMapOutputModes(self, a, ctypes.byref(c))
+        if status:
+            _printError(status, "Supported map output modes")
+            return None
+        return tuple(a[:c.value])
+
+    def _properties(self):
+        '''(INTERNAL) Return the cached properties of the node, which
+        are dropped when its map output mode or field of view change.
+        '''
+        try:
+            c = self._cache
+        except AttributeError:
+            c = self._newCache()
+        p = c.get('properties', None)
+        if p is None:
+            p = c['properties'] = {}
+            v = self._as_parameter_.value
+            if v not in _PropertyWatches:
+                def changed(hNode, pCookie):
+                    o = _Cobjects.get((NodeHandle, v), None)
+                    if o is not None:
+                        o.invalidateProperties()
+                t = []
+                for r, u in ((dll.xnRegisterToMapOutputModeChange,
+                              dll.xnUnregisterFromMapOutputModeChange),
+                             (dll.xnRegisterToDepthFieldOfViewChange,
+                              dll.xnUnregisterFromDepthFieldOfViewChange)):
+                    f = cb.StateChangedHandler(changed)
+                    h = ctypes.c_void_p()
+                    if not r(self, f, None, ctypes.byref(h)):  # else not supported
+                        t.append((u, h, f))
+                _PropertyWatches[v] = t
+        return p
+
+    def _getProperty(self, name, get, new, *args):
+        '''(INTERNAL) Return property name, cached, else read by get
+        into the value returned by new().
+        '''
+        p = self._properties()
+        try:
+            return p[name]
+        except KeyError:
+            pass
+        value = new()
+        status = get(self, name, value, *args)
+        if status:
+            _printError(status, "Property %s" % (name,))
+            return None
+        v = p[name] = value.value
+        return v
+
+    def getCachedIntProperty(self, strName):
+        '''Return an integer property, e.g. Prop.ZERO_PLANE_DISTANCE, None on error.
+
+        Repeated reads are served from memory until a property is set
+        with set*Property(), the map output mode or field of view of the
+        node change, or invalidateProperties() is called.
+        '''
+        return self._getProperty(strName, xnGetIntProperty_into, ctypes.c_uint64)
+
+    def getCachedRealProperty(self, strName):
+        '''Return a real property, None on error, see getCachedIntProperty().
+        '''
+        return self._getProperty(strName, xnGetRealProperty_into, ctypes.c_double)
+
+    def getCachedStringProperty(self, strName):
+        '''Return a string property, None on error, see getCachedIntProperty().
+        '''
+        return self._getProperty(strName, xnGetStringProperty_into,
+                                 lambda: ctypes.create_string_buffer(2048), 2048)
+
+    def invalidateProperties(self):
+        '''Drop the cached properties of the node.
+        '''
+        try:
+            self._cache.pop('properties', None)
+        except AttributeError:
+            pass
+
+    def setIntProperty(self, strName, nValue):
+        '''Sets an integer property, and drops the cached properties.
+        '''
+        status = xnSetIntProperty(self, strName, nValue)
+        self.invalidateProperties()
+        return status
+
+    def setRealProperty(self, strName, dValue):
+        '''Sets a real property, and drops the cached properties.
+        '''
+        status = xnSetRealProperty(self, strName, dValue)
+        self.invalidateProperties()
+        return status
+
+    def setStringProperty(self, strName, strValue):
+        '''Sets a string property, and drops the cached properties.
+        '''
+        status = xnSetStringProperty(self, strName, strValue)
+        self.invalidateProperties()
+        return status
+
+    def release(self):
+        '''Unreference a production node, and drop its cached queries
+        and properties.
+        '''
+        _unwatchProperties(self._as_parameter_.value)
+        self._dropCache()
+        xnProductionNodeRelease(self)
 
 class NodeQuery(_Ctype):
     """Create a new NodeQuery instance.
 
-    # FIXME: handle destruction
+    It is freed when garbage collected, or by free(), e.g. on exit
+    of a with statement.  OpenNI cannot clear a query, so queries
+    are not pooled, unlike EnumerationErrors and NodeInfoList.
     """
     def __new__(cls, *args):
         if args and args[0]:
-            p = args[0]
-        else:
-            p = ctypes.c_void_p()
-            status = dll.xnNodeQueryAllocate(ctypes.byref(p))
-            if status:
-                xnPrintError(status, "NodeQuery creation")
-                return None
-        return _Cobject(cls, p)
+            return _Constructor(cls, args[0])
+        p = ctypes.c_void_p()
+        status = dll.xnNodeQueryAllocate(ctypes.byref(p))
+        if status:
+            _printError(status, "NodeQuery creation")
+            return None
+        return _Cown(_Cobject(cls, p), dll.xnNodeQueryFree)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.free()
+
+    def free(self):
+        '''Free the native query now, rather than when garbage collected.
+        '''
+        _Cfree(self, dll.xnNodeQueryFree)
 
 class EnumerationErrors(_Ctype):
     """Create a new EnumerationErrors instance.
 
-    # FIXME: handle destruction
+    It is freed when garbage collected, or by free(), e.g. on exit
+    of a with statement.  See HandlePool to reuse instances.
     """
     def __new__(cls, *args):
         if args and args[0]:
-            p = args[0]
-        else:
-            p = ctypes.c_void_p()
-            status = dll.xnEnumerationErrorsAllocate(ctypes.byref(p))
-            if status:
-                xnPrintError(status, "EnumerationErrors creation")
-                return None
-        return _Cobject(cls, p)
+            return _Constructor(cls, args[0])
+        p = ctypes.c_void_p()
+        status = dll.xnEnumerationErrorsAllocate(ctypes.byref(p))
+        if status:
+            _printError(status, "EnumerationErrors creation")
+            return None
+        return _Cown(_Cobject(cls, p), dll.xnEnumerationErrorsFree)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.free()
+
+    def free(self):
+        '''Free the native errors now, rather than when garbage collected.
+        '''
+        _Cfree(self, dll.xnEnumerationErrorsFree)
 
 class NodeInfoList(_Ctype):
     """Create a new NodeInfoList instance.
 
-    # FIXME: handle destruction
+    It is freed when garbage collected, or by free(), e.g. on exit
+    of a with statement.  Lists returned by OpenNI are only freed
+    by free().  See HandlePool to reuse instances.
     """
     def __new__(cls, *args):
         if args and args[0]:
-            p = args[0]
-        else:
-            p = ctypes.c_void_p()
-            status = dll.xnNodeInfoListAllocate(ctypes.byref(p))
-            if status:
-                xnPrintError(status, "NodeInfoList creation")
-                return None
+            return _Constructor(cls, args[0])
+        p = ctypes.c_void_p()
+        status = dll.xnNodeInfoListAllocate(ctypes.byref(p))
+        if status:
+            _printError(status, "NodeInfoList creation")
+            return None
+        return _Cown(_Cobject(cls, p), dll.xnNodeInfoListFree)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.free()
+
+    def free(self):
+        '''Free the native list now, rather than when garbage collected.
+        '''
+        _Cfree(self, dll.xnNodeInfoListFree)
+
+    def infos(self):
+        '''Return the NodeInfos of the list, fetched in one pass.
+        '''
+        t = []
+        it = xnNodeInfoListGetFirst(self)
+        while xnNodeInfoListIteratorIsValid(it):
+            t.append(xnNodeInfoListGetCurrent(it))
+            it = xnNodeInfoListGetNext(it)
+        return NodeInfos(t, self)
 
-        return _Cobject(cls, p)
+    def __iter__(self):
+        return iter(self.infos())
 
@@ -0,0 +1,125 @@
+#! /usr/bin/python
+
+"""Point clouds from the depth maps of a depth generator.
+
+The real world coordinates of a depth pixel (x, y) are its depth times
+a per-pixel ray, which only depends on the output mode and the field of
+view of the device.  The rays are computed once per resolution and
+device, kept in memory and saved as .npy files in a cache directory,
+which later runs memory-map.  Each depth frame is then converted to
+XYZ points with a single numpy multiply, without any native
+xnConvertProjectiveToRealWorld call.
+"""
+
+import ctypes
+import os
+
+import numpy
+
+import ni
+
+# Default directory of the .npy rays cache, None for no files.
+CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                     os.path.join(os.path.expanduser('~'), '.cache'), 'ni')
+
+_rays = {}  # (xres, yres, hfov, vfov) -> rays
+
+def rays(xres, yres, hfov, vfov, cache=CACHE):
+    """Return the (yres, xres, 3) float32 rays for an output mode and
+    field of view, the same as xnConvertProjectiveToRealWorld: the XYZ
+    of a pixel is its depth times its ray.
+
+    @param hfov: horizontal field of view, in radians.
+    @param vfov: vertical field of view, in radians.
+    @param cache: the directory of the .npy files, None for memory only.
+    @return: a read-only array, memory-mapped when cached in a file.
+    """
+    key = (int(xres), int(yres), float(hfov), float(vfov))
+    r = _rays.get(key, None)
+    if r is not None:
+        return r
+
+    path = cache and os.path.join(cache, 'rays-%dx%d-%.9g-%.9g.npy' % key)
+    if path and os.path.exists(path):
+        r = numpy.load(path, mmap_mode='r')
+        if r.shape != (key[1], key[0], 3) or r.dtype != numpy.float32:
+            r = None  # stale or foreign file
+    if r is None:
+        xres, yres, hfov, vfov = key
+        r = numpy.empty((yres, xres, 3), dtype=numpy.float32)
+        r[:, :, 0] = (numpy.arange(xres) / float(xres) - 0.5) * (numpy.tan(hfov / 2) * 2)
+        r[:, :, 1] = ((0.5 - numpy.arange(yres) / float(yres)) * (numpy.tan(vfov / 2) * 2))[:, None]
+        r[:, :, 2] = 1
+        if path:
+            _save(path, r)
+        r.flags.writeable = False
+    _rays[key] = r
+    return r
+
+def _save(path, a):
+    """(INTERNAL) Save array a atomically, ignoring errors: the cache is
+    only an optimization.
+    """
+    t = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(t, 'wb') as f:
+            numpy.save(f, a)
+        os.rename(t, path)
+    except (IOError, OSError):
+        if os.path.exists(t):
+            os.remove(t)
+
+class PointCloud(object):
+    """Convert the depth maps of a depth generator to XYZ points.
+
+    @param depth: the depth generator L{ni.NodeHandle}.
+    @param cache: the rays cache directory, see L{rays}.
+    """
+    def __init__(self, depth, cache=CACHE):
+        self.depth = depth
+        self.cache = cache
+        self._mode = None  # (xres, yres) of self._rays
+
+    def rays(self):
+        """Return the rays for the current output mode, None on error.
+
+        The field of view is only queried when the output mode changes.
+        """
+        m = ni.MapOutputMode()
+        status = ni.dll.xnGetMapOutputMode(self.depth, ctypes.byref(m))
+        if status:
+            ni.xnPrintError(status, "Map output mode")
+            return None
+        mode = (int(m.nXRes), int(m.nYRes))
+        if mode != self._mode:
+            f = ni.FieldOfView()
+            status = ni.dll.xnGetDepthFieldOfView(self.depth, ctypes.byref(f))
+            if status:
+                ni.xnPrintError(status, "Depth field of view")
+                return None
+            self._rays = rays(mode[0], mode[1], f.fHFOV, f.fVFOV, self.cache)
+            self._mode = mode
+        return self._rays
+
+    def points(self, view=None, out=None):
+        """Return the (nYRes, nXRes, 3) float32 XYZ points, in millimeters,
+        of a depth map, None on error.  Pixels without depth are (0, 0, 0).
+
+        @param view: the depth L{ni.MapView} or (nYRes, nXRes) array,
+        by default the current depth map.
+        @param out: optional, preallocated (nYRes, nXRes, 3) float32 result.
+        """
+        if view is None:
+            view = self.depth.getDepthMapView()
+            if view is None:
+                return None
+        if isinstance(view, ni.MapView):
+            view = view.array
+        r = self.rays()
+        if r is None:
+            return None
+        if view.shape != r.shape[:2]:
+            raise ValueError('expected a %r depth map, not %r' % (r.shape[:2], view.shape))
+        return numpy.multiply(view[:, :, None], r, out=out)
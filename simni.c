@@ -0,0 +1,1104 @@
+/* Simulated OpenNI library, for tests and benchmarks without a sensor.
+ *
+ * Implements the core of the OpenNI C API: contexts, enumeration and
+ * creation of devices, depth, image, IR, user and scene nodes, the
+ * wait*UpdateAll functions, map getters, output modes, point conversion,
+ * skeletons, node properties and the new data, user, output mode and
+ * node callbacks.
+ * The generators produce synthetic frames in real time: a person-sized
+ * disc moving in front of a tilted wall, with its label map and a
+ * tracked skeleton.
+ *
+ * Build with "make sim", then load it instead of OpenNI with
+ *     NI_LIBRARY=./libOpenNIsim.so python ...
+ * The environment variables NI_SIM_XRES, NI_SIM_YRES, NI_SIM_FPS
+ * (640, 480, 30) set the default output mode, NI_SIM_DEVICES (1) the
+ * number of enumerated devices.  POSIX only.
+ */
+
+#include <math.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#ifndef M_PI
+#define M_PI 3.14159265358979323846
+#endif
+
+typedef uint32_t XnStatus;
+
+#define SIM_OK              0
+#define SIM_ERROR           0x10001  /* simulated failures */
+#define SIM_BAD_PARAM       0x10002
+#define SIM_NO_MATCH        0x10003
+#define SIM_NOT_GENERATING  0x10004
+#define SIM_JOINT_INACTIVE  0x10005
+#define SIM_NO_PROPERTY     0x10006
+
+/* XnProductionNodeType */
+enum { SIM_DEVICE = 1, SIM_DEPTH = 2, SIM_IMAGE = 3, SIM_IR = 5, SIM_USER = 6, SIM_SCENE = 10 };
+
+typedef struct { uint32_t nXRes, nYRes, nFPS; } MapOutputMode;
+typedef struct { double fHFOV, fVFOV; } FieldOfView;
+typedef struct { float X, Y, Z; } Point3D;
+typedef struct {
+    Point3D position;
+    float fPositionConfidence;
+    float orientation[9];
+    float fOrientationConfidence;
+} JointTransformation;
+
+typedef void (*StateChangedHandler)(void *node, void *cookie);
+typedef void (*UserHandler)(void *node, uint32_t user, void *cookie);
+typedef void (*NodeCreationHandler)(void *context, void *node, void *cookie);
+typedef void (*NodeDestructionHandler)(void *context, const char *name, void *cookie);
+
+enum { CB_NEW_DATA, CB_MODE_CHANGE, CB_FOV_CHANGE, CB_USER, CB_NODE_CREATION, CB_NODE_DESTRUCTION };
+
+struct Node;
+struct Context;
+
+typedef struct Callback {
+    int event;
+    void (*f)(void);
+    void (*f2)(void);  /* lost user handler */
+    void *cookie;
+    struct Node *node;
+    pthread_t thread;  /* new data notifications */
+    volatile int running;
+    struct Callback *next;
+} Callback;
+
+enum { PROP_INT, PROP_REAL, PROP_STRING };
+
+typedef struct {
+    char name[32];
+    int type;
+    uint64_t i;
+    double r;
+    char s[64];
+} Property;
+
+#define MAX_PROPERTIES 16
+
+typedef struct Node {
+    struct Context *context;
+    int type;
+    int device;
+    char name[32];
+    int refs;
+    int generating;
+    double start;  /* time of frame 1 */
+    MapOutputMode mode;
+    uint32_t frameID;
+    uint64_t timestamp;  /* microseconds */
+    void *map;
+    size_t size;
+    int users;  /* users announced to the user callbacks */
+    Callback *callbacks;
+    Property properties[MAX_PROPERTIES];
+    int nproperties;
+    struct Node *next;
+} Node;
+
+typedef struct Context {
+    pthread_mutex_t lock;
+    int refs;
+    Node *nodes;
+    Callback *callbacks;
+    int count;  /* created nodes, for names */
+} Context;
+
+typedef struct {
+    int type;
+    int device;
+    char creationInfo[32];
+} NodeInfo;
+
+typedef struct ListNode {
+    NodeInfo info;
+    struct ListNode *next, *prev;
+} ListNode;
+
+typedef struct { ListNode *first; } NodeInfoList;
+
+typedef struct { char needed[32]; } Query;  /* name of the needed node */
+
+/* Configuration */
+
+static int env(const char *name, int value)
+{
+    const char *s = getenv(name);
+    return s && atoi(s) > 0 ? atoi(s) : value;
+}
+
+static MapOutputMode default_mode(void)
+{
+    MapOutputMode m;
+    m.nXRes = env("NI_SIM_XRES", 640);
+    m.nYRes = env("NI_SIM_YRES", 480);
+    m.nFPS = env("NI_SIM_FPS", 30);
+    return m;
+}
+
+static const FieldOfView fov = { 1.0144686707507438, 0.78980943449644714 };
+
+static double now(void)
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec * 1e-9;
+}
+
+static void sleep_until(double t)
+{
+    double d = t - now();
+    struct timespec s;
+    if (d <= 0)
+        return;
+    s.tv_sec = (time_t)d;
+    s.tv_nsec = (long)((d - s.tv_sec) * 1e9);
+    nanosleep(&s, NULL);
+}
+
+/* Frames */
+
+static int is_map(const Node *n)
+{
+    return n->type == SIM_DEPTH || n->type == SIM_IMAGE || n->type == SIM_IR || n->type == SIM_SCENE;
+}
+
+static int is_generator(const Node *n)
+{
+    return is_map(n) || n->type == SIM_USER;
+}
+
+/* The last frame ID produced by a generating node */
+static uint32_t produced(const Node *n, double t)
+{
+    if (!n->generating || t < n->start)
+        return n->frameID;
+    return (uint32_t)((t - n->start) * n->mode.nFPS) + 1;
+}
+
+static double frame_time(const Node *n, uint32_t frame)
+{
+    return n->start + (frame - 1) / (double)n->mode.nFPS;
+}
+
+/* The person disc at time t (seconds), in pixels of mode m */
+static void person(const MapOutputMode *m, double t, double *cx, double *cy, double *r)
+{
+    *cx = m->nXRes * (0.5 + 0.3 * sin(2 * M_PI * t / 5));
+    *cy = m->nYRes * 0.55;
+    *r = m->nYRes / 5.0;
+}
+
+static size_t pixel_size(const Node *n)
+{
+    return n->type == SIM_IMAGE ? 3 : 2;
+}
+
+static void allocate(Node *n)
+{
+    if (!is_map(n))
+        return;
+    free(n->map);
+    n->size = (size_t)n->mode.nXRes * n->mode.nYRes * pixel_size(n);
+    n->map = calloc(1, n->size);
+}
+
+static void render(Node *n)
+{
+    uint32_t x, y, w = n->mode.nXRes, h = n->mode.nYRes;
+    double cx, cy, r;
+    person(&n->mode, n->timestamp * 1e-6, &cx, &cy, &r);
+    for (y = 0; y < h; y++) {
+        for (x = 0; x < w; x++) {
+            double dx = x - cx, dy = y - cy, d2 = dx * dx + dy * dy;
+            int in = d2 < r * r;
+            uint16_t depth = in ? (uint16_t)(1500 - 200 * sqrt(1 - d2 / (r * r)))
+                                : (uint16_t)(2500 + y * 1000 / h);
+            size_t i = (size_t)y * w + x;
+            switch (n->type) {
+            case SIM_DEPTH:
+                ((uint16_t *)n->map)[i] = depth;
+                break;
+            case SIM_IR:
+                ((uint16_t *)n->map)[i] = depth / 4;
+                break;
+            case SIM_SCENE:
+                ((uint16_t *)n->map)[i] = in;
+                break;
+            case SIM_IMAGE: {
+                uint8_t *p = (uint8_t *)n->map + 3 * i;
+                p[0] = in ? 200 : (uint8_t)(x * 255 / w);
+                p[1] = in ? 80 : (uint8_t)(y * 255 / h);
+                p[2] = in ? 60 : 128;
+                break;
+            }
+            }
+        }
+    }
+}
+
+/* Update the nodes with new frames, return the user nodes with a new user */
+static int update(Context *c, Node **announce, int max)
+{
+    double t = now();
+    int k = 0;
+    Node *n;
+    for (n = c->nodes; n; n = n->next) {
+        uint32_t f = produced(n, t);
+        if (!is_generator(n) || f == n->frameID)
+            continue;
+        n->frameID = f;
+        n->timestamp = (uint64_t)((f - 1) * 1e6 / n->mode.nFPS);
+        if (is_map(n))
+            render(n);
+        else if (!n->users) {
+            n->users = 1;
+            if (k < max)
+                announce[k++] = n;
+        }
+    }
+    return k;
+}
+
+static void announce_users(Node **announce, int k)
+{
+    int i;
+    for (i = 0; i < k; i++) {
+        Callback *cb;
+        for (cb = announce[i]->callbacks; cb; cb = cb->next)
+            if (cb->event == CB_USER && cb->f)
+                ((UserHandler)cb->f)(announce[i], 1, cb->cookie);
+    }
+}
+
+enum { WAIT_ALL, WAIT_ANY, WAIT_ONE, WAIT_NONE };
+
+static XnStatus wait_update(Context *c, int how, Node *one)
+{
+    double deadline = now() + 2, next;
+    Node *announce[16];
+    int k;
+    if (!c)
+        return SIM_BAD_PARAM;
+    pthread_mutex_lock(&c->lock);
+    for (;;) {
+        double t = now();
+        int waiting = 0, ready = 0, some = 0;
+        Node *n;
+        next = deadline;
+        for (n = c->nodes; n; n = n->next) {
+            if (!is_generator(n) || !n->generating || (how == WAIT_ONE && n != one))
+                continue;
+            some = 1;
+            if (produced(n, t) != n->frameID)
+                ready++;
+            else {
+                double f = frame_time(n, n->frameID + 1);
+                waiting++;
+                if (f < next)
+                    next = f;
+            }
+        }
+        if (!some) {
+            pthread_mutex_unlock(&c->lock);
+            return SIM_NOT_GENERATING;
+        }
+        if (how == WAIT_NONE || (how == WAIT_ALL ? !waiting : ready))
+            break;
+        if (t >= deadline) {
+            pthread_mutex_unlock(&c->lock);
+            return SIM_ERROR;  /* wait timeout */
+        }
+        pthread_mutex_unlock(&c->lock);
+        sleep_until(next);
+        pthread_mutex_lock(&c->lock);
+    }
+    k = update(c, announce, 16);
+    pthread_mutex_unlock(&c->lock);
+    announce_users(announce, k);  /* in the updating thread, as OpenNI */
+    return SIM_OK;
+}
+
+/* Context */
+
+XnStatus xnInit(Context **pp)
+{
+    Context *c;
+    if (!pp)
+        return SIM_BAD_PARAM;
+    c = calloc(1, sizeof(Context));
+    if (!c)
+        return SIM_ERROR;
+    pthread_mutex_init(&c->lock, NULL);
+    c->refs = 1;
+    *pp = c;
+    return SIM_OK;
+}
+
+XnStatus xnInitFromXmlFile(const char *file, Context **pp, void *errors)
+{
+    return xnInit(pp);  /* the configuration is ignored */
+}
+
+XnStatus xnContextAddRef(Context *c)
+{
+    if (!c)
+        return SIM_BAD_PARAM;
+    c->refs++;
+    return SIM_OK;
+}
+
+XnStatus xnGetRefContextFromNodeHandle(Node *n, Context **pp)
+{
+    if (!n || !pp)
+        return SIM_BAD_PARAM;
+    *pp = n->context;
+    return xnContextAddRef(n->context);
+}
+
+static void free_node(Node *n)
+{
+    Callback *cb = n->callbacks;
+    while (cb) {
+        Callback *next = cb->next;
+        if (cb->event == CB_NEW_DATA) {
+            cb->running = 0;
+            pthread_join(cb->thread, NULL);
+        }
+        free(cb);
+        cb = next;
+    }
+    free(n->map);
+    free(n);
+}
+
+void xnContextRelease(Context *c)
+{
+    Node *n;
+    Callback *cb;
+    if (!c || --c->refs > 0)
+        return;
+    while ((n = c->nodes)) {
+        c->nodes = n->next;
+        free_node(n);
+    }
+    while ((cb = c->callbacks)) {
+        c->callbacks = cb->next;
+        free(cb);
+    }
+    pthread_mutex_destroy(&c->lock);
+    free(c);
+}
+
+void xnShutdown(Context *c)
+{
+    xnContextRelease(c);
+}
+
+XnStatus xnStartGeneratingAll(Context *c)
+{
+    Node *n;
+    double t = now();
+    if (!c)
+        return SIM_BAD_PARAM;
+    pthread_mutex_lock(&c->lock);
+    for (n = c->nodes; n; n = n->next)
+        if (is_generator(n) && !n->generating) {
+            n->generating = 1;
+            n->start = t;
+        }
+    pthread_mutex_unlock(&c->lock);
+    return SIM_OK;
+}
+
+XnStatus xnStopGeneratingAll(Context *c)
+{
+    Node *n;
+    if (!c)
+        return SIM_BAD_PARAM;
+    for (n = c->nodes; n; n = n->next)
+        n->generating = 0;
+    return SIM_OK;
+}
+
+XnStatus xnWaitAndUpdateAll(Context *c) { return wait_update(c, WAIT_ALL, NULL); }
+XnStatus xnWaitAnyUpdateAll(Context *c) { return wait_update(c, WAIT_ANY, NULL); }
+XnStatus xnWaitOneUpdateAll(Context *c, Node *n) { return wait_update(c, WAIT_ONE, n); }
+XnStatus xnWaitNoneUpdateAll(Context *c) { return wait_update(c, WAIT_NONE, NULL); }
+
+/* Nodes */
+
+static const char *type_name(int type)
+{
+    switch (type) {
+    case SIM_DEVICE: return "Device";
+    case SIM_DEPTH: return "Depth";
+    case SIM_IMAGE: return "Image";
+    case SIM_IR: return "IR";
+    case SIM_USER: return "User";
+    case SIM_SCENE: return "Scene";
+    }
+    return "Node";
+}
+
+static Property *property(Node *n, const char *name, int type, int add);
+
+/* The zero plane distance of the depth nodes in mm, and their zero
+   plane pixel size in mm per pixel of the 1280 wide SXGA sensor, as
+   PrimeSense sensors report them: both give fov.fHFOV */
+#define ZERO_PLANE_DISTANCE 120
+
+static XnStatus create(Context *c, int type, int device, Node **ph)
+{
+    Node *n;
+    Callback *cb;
+    if (!c || !ph)
+        return SIM_BAD_PARAM;
+    n = calloc(1, sizeof(Node));
+    if (!n)
+        return SIM_ERROR;
+    n->context = c;
+    n->type = type;
+    n->device = device;
+    n->refs = 1;
+    n->mode = default_mode();
+    allocate(n);
+    if (type == SIM_DEPTH) {
+        property(n, "ZPD", PROP_INT, 1)->i = ZERO_PLANE_DISTANCE;
+        property(n, "ZPPS", PROP_REAL, 1)->r = 2 * ZERO_PLANE_DISTANCE * tan(fov.fHFOV / 2) / 1280;
+    }
+    pthread_mutex_lock(&c->lock);
+    snprintf(n->name, sizeof(n->name), "%s%d", type_name(type), ++c->count);
+    n->next = c->nodes;
+    c->nodes = n;
+    pthread_mutex_unlock(&c->lock);
+    *ph = n;
+    for (cb = c->callbacks; cb; cb = cb->next)
+        if (cb->event == CB_NODE_CREATION)
+            ((NodeCreationHandler)cb->f)(c, n, cb->cookie);
+    return SIM_OK;
+}
+
+/* The device of the node needed by query, 0 without one, -1 if the
+   context has no such node */
+static int query_device(Context *c, const Query *q)
+{
+    Node *n;
+    int device = -1;
+    if (!q || !q->needed[0])
+        return 0;
+    pthread_mutex_lock(&c->lock);
+    for (n = c->nodes; n; n = n->next)
+        if (!strcmp(n->name, q->needed)) {
+            device = n->device;
+            break;
+        }
+    pthread_mutex_unlock(&c->lock);
+    return device;
+}
+
+static XnStatus create_generator(Context *c, int type, const Query *q, Node **ph)
+{
+    int device;
+    if (!c)
+        return SIM_BAD_PARAM;
+    device = query_device(c, q);
+    if (device < 0)
+        return SIM_NO_MATCH;
+    return create(c, type, device, ph);
+}
+
+XnStatus xnCreateDepthGenerator(Context *c, Node **ph, Query *q, void *errors) { return create_generator(c, SIM_DEPTH, q, ph); }
+XnStatus xnCreateImageGenerator(Context *c, Node **ph, Query *q, void *errors) { return create_generator(c, SIM_IMAGE, q, ph); }
+XnStatus xnCreateIRGenerator(Context *c, Node **ph, Query *q, void *errors) { return create_generator(c, SIM_IR, q, ph); }
+XnStatus xnCreateUserGenerator(Context *c, Node **ph, Query *q, void *errors) { return create_generator(c, SIM_USER, q, ph); }
+XnStatus xnCreateSceneAnalyzer(Context *c, Node **ph, Query *q, void *errors) { return create_generator(c, SIM_SCENE, q, ph); }
+
+XnStatus xnProductionNodeAddRef(Node *n)
+{
+    if (!n)
+        return SIM_BAD_PARAM;
+    n->refs++;
+    return SIM_OK;
+}
+
+void xnProductionNodeRelease(Node *n)
+{
+    Context *c;
+    Node **p;
+    Callback *cb;
+    char name[32];
+    if (!n || --n->refs > 0)
+        return;
+    c = n->context;
+    pthread_mutex_lock(&c->lock);
+    for (p = &c->nodes; *p; p = &(*p)->next)
+        if (*p == n) {
+            *p = n->next;
+            break;
+        }
+    pthread_mutex_unlock(&c->lock);
+    strcpy(name, n->name);
+    free_node(n);
+    for (cb = c->callbacks; cb; cb = cb->next)
+        if (cb->event == CB_NODE_DESTRUCTION)
+            ((NodeDestructionHandler)cb->f)(c, name, cb->cookie);
+}
+
+const char *xnGetNodeName(Node *n) { return n ? n->name : NULL; }
+
+XnStatus xnStartGenerating(Node *n)
+{
+    if (!n || !is_generator(n))
+        return SIM_BAD_PARAM;
+    if (!n->generating) {
+        n->generating = 1;
+        n->start = now();
+    }
+    return SIM_OK;
+}
+
+XnStatus xnStopGenerating(Node *n)
+{
+    if (!n)
+        return SIM_BAD_PARAM;
+    n->generating = 0;
+    return SIM_OK;
+}
+
+int xnIsGenerating(Node *n) { return n && n->generating; }
+
+int xnIsCapabilitySupported(Node *n, const char *name)
+{
+    if (!n || !name)
+        return 0;
+    if (n->type == SIM_USER)
+        return !strcmp(name, "User::Skeleton");
+    return is_map(n) && !strcmp(name, "Mirror");
+}
+
+uint32_t xnGetFrameID(Node *n) { return n ? n->frameID : 0; }
+uint64_t xnGetTimestamp(Node *n) { return n ? n->timestamp : 0; }
+uint32_t xnGetDataSize(Node *n) { return n ? (uint32_t)n->size : 0; }
+
+int xnIsNewDataAvailable(Node *n, uint64_t *timestamp)
+{
+    uint32_t f;
+    if (!n)
+        return 0;
+    f = produced(n, now());
+    if (timestamp)
+        *timestamp = (uint64_t)((f ? f - 1 : 0) * 1e6 / n->mode.nFPS);
+    return f != n->frameID;
+}
+
+/* Maps */
+
+XnStatus xnGetMapOutputMode(Node *n, MapOutputMode *m)
+{
+    if (!n || !m || !is_map(n))
+        return SIM_BAD_PARAM;
+    *m = n->mode;
+    return SIM_OK;
+}
+
+XnStatus xnSetMapOutputMode(Node *n, const MapOutputMode *m)
+{
+    Callback *cb;
+    if (!n || !m || !is_map(n) || !m->nXRes || !m->nYRes || !m->nFPS)
+        return SIM_BAD_PARAM;
+    pthread_mutex_lock(&n->context->lock);
+    n->mode = *m;
+    allocate(n);
+    n->frameID = 0;
+    n->start = now();
+    pthread_mutex_unlock(&n->context->lock);
+    for (cb = n->callbacks; cb; cb = cb->next)
+        if (cb->event == CB_MODE_CHANGE)
+            ((StateChangedHandler)cb->f)(n, cb->cookie);
+    return SIM_OK;
+}
+
+static const MapOutputMode modes[] = {
+    {320, 240, 30}, {320, 240, 60}, {640, 480, 30}, {640, 480, 60}, {1280, 1024, 15}
+};
+
+uint32_t xnGetSupportedMapOutputModesCount(Node *n)
+{
+    return n && is_map(n) ? sizeof(modes) / sizeof(modes[0]) : 0;
+}
+
+XnStatus xnGetSupportedMapOutputModes(Node *n, MapOutputMode *a, uint32_t *count)
+{
+    uint32_t i, k = xnGetSupportedMapOutputModesCount(n);
+    if (!a || !count)
+        return SIM_BAD_PARAM;
+    if (*count < k)
+        k = *count;
+    for (i = 0; i < k; i++)
+        a[i] = modes[i];
+    *count = k;
+    return SIM_OK;
+}
+
+uint32_t xnGetBytesPerPixel(Node *n) { return n && is_map(n) ? (uint32_t)pixel_size(n) : 0; }
+
+static void *map(Node *n, int type)
+{
+    return n && n->type == type && n->frameID ? n->map : NULL;
+}
+
+uint16_t *xnGetDepthMap(Node *n) { return map(n, SIM_DEPTH); }
+uint8_t *xnGetImageMap(Node *n) { return map(n, SIM_IMAGE); }
+uint8_t *xnGetRGB24ImageMap(Node *n) { return map(n, SIM_IMAGE); }
+uint16_t *xnGetIRMap(Node *n) { return map(n, SIM_IR); }
+uint16_t *xnGetLabelMap(Node *n) { return map(n, SIM_SCENE); }
+uint16_t xnGetDeviceMaxDepth(Node *n) { return 10000; }
+
+XnStatus xnGetDepthFieldOfView(Node *n, FieldOfView *f)
+{
+    if (!n || !f)
+        return SIM_BAD_PARAM;
+    *f = fov;
+    return SIM_OK;
+}
+
+XnStatus xnConvertProjectiveToRealWorld(Node *n, uint32_t count, const Point3D *a, Point3D *b)
+{
+    uint32_t i;
+    double kx, ky;
+    if (!n || !is_map(n))
+        return SIM_BAD_PARAM;
+    kx = 2 * tan(fov.fHFOV / 2);
+    ky = 2 * tan(fov.fVFOV / 2);
+    for (i = 0; i < count; i++) {
+        float z = a[i].Z;
+        b[i].X = (float)((a[i].X / n->mode.nXRes - .5) * z * kx);
+        b[i].Y = (float)((.5 - a[i].Y / n->mode.nYRes) * z * ky);
+        b[i].Z = z;
+    }
+    return SIM_OK;
+}
+
+XnStatus xnConvertRealWorldToProjective(Node *n, uint32_t count, const Point3D *a, Point3D *b)
+{
+    uint32_t i;
+    double kx, ky;
+    if (!n || !is_map(n))
+        return SIM_BAD_PARAM;
+    kx = 2 * tan(fov.fHFOV / 2);
+    ky = 2 * tan(fov.fVFOV / 2);
+    for (i = 0; i < count; i++) {
+        float z = a[i].Z;
+        b[i].X = (float)((a[i].X / z / kx + .5) * n->mode.nXRes);
+        b[i].Y = (float)((.5 - a[i].Y / z / ky) * n->mode.nYRes);
+        b[i].Z = z;
+    }
+    return SIM_OK;
+}
+
+/* Users and skeletons: one tracked user, the person disc */
+
+uint16_t xnGetNumberOfUsers(Node *n)
+{
+    return n && n->type == SIM_USER && n->users ? 1 : 0;
+}
+
+XnStatus xnGetUsers(Node *n, uint32_t *users, uint16_t *count)
+{
+    if (!n || !users || !count)
+        return SIM_BAD_PARAM;
+    if (*count > xnGetNumberOfUsers(n))
+        *count = xnGetNumberOfUsers(n);
+    if (*count)
+        users[0] = 1;
+    return SIM_OK;
+}
+
+int xnIsSkeletonTracking(Node *n, uint32_t user) { return xnGetNumberOfUsers(n) && user == 1; }
+int xnIsSkeletonCalibrated(Node *n, uint32_t user) { return xnIsSkeletonTracking(n, user); }
+
+/* XnSkeletonJoint offsets from the torso, in millimeters; 0, 0 for
+   the joints which OpenNI does not track */
+static const float joints[25][2] = {
+    {0, 0},
+    {0, 450}, {0, 300}, {0, 0}, {0, 0},          /* head, neck, torso, waist */
+    {0, 0}, {-180, 280}, {-420, 260}, {0, 0},    /* left collar, shoulder, elbow, wrist */
+    {-640, 250}, {0, 0},                         /* left hand, fingertip */
+    {0, 0}, {180, 280}, {420, 260}, {0, 0},      /* right collar, shoulder, elbow, wrist */
+    {640, 250}, {0, 0},                          /* right hand, fingertip */
+    {-100, -200}, {-110, -600}, {0, 0}, {-120, -950},  /* left hip, knee, ankle, foot */
+    {100, -200}, {110, -600}, {0, 0}, {120, -950}      /* right hip, knee, ankle, foot */
+};
+
+int xnIsJointAvailable(Node *n, int joint)
+{
+    return joint > 0 && joint < 25 && (joint == 3 || joints[joint][0] || joints[joint][1]);
+}
+
+int xnIsJointActive(Node *n, int joint) { return xnIsJointAvailable(n, joint); }
+
+XnStatus xnGetSkeletonJoint(Node *n, uint32_t user, int joint, JointTransformation *t)
+{
+    const MapOutputMode *m;
+    double cx, cy, r, kx, ky, z = 1500;
+    if (!t || !xnIsSkeletonTracking(n, user))
+        return SIM_BAD_PARAM;
+    if (!xnIsJointAvailable(n, joint))
+        return SIM_JOINT_INACTIVE;
+    m = &n->mode;
+    person(m, n->timestamp * 1e-6, &cx, &cy, &r);
+    kx = 2 * tan(fov.fHFOV / 2);
+    ky = 2 * tan(fov.fVFOV / 2);
+    memset(t, 0, sizeof(*t));
+    t->position.X = (float)((cx / m->nXRes - .5) * z * kx + joints[joint][0]);
+    t->position.Y = (float)((.5 - cy / m->nYRes) * z * ky + joints[joint][1]);
+    t->position.Z = (float)z;
+    t->fPositionConfidence = 1;
+    t->orientation[0] = t->orientation[4] = t->orientation[8] = 1;
+    t->fOrientationConfidence = 1;
+    return SIM_OK;
+}
+
+/* Callbacks */
+
+static XnStatus add_callback(Callback **list, int event, void (*f)(void), void (*f2)(void),
+                             void *cookie, Node *n, Callback **ph)
+{
+    Callback *cb;
+    if (!ph)
+        return SIM_BAD_PARAM;
+    cb = calloc(1, sizeof(Callback));
+    if (!cb)
+        return SIM_ERROR;
+    cb->event = event;
+    cb->f = f;
+    cb->f2 = f2;
+    cb->cookie = cookie;
+    cb->node = n;
+    cb->next = *list;
+    *list = cb;
+    *ph = cb;
+    return SIM_OK;
+}
+
+static void remove_callback(Callback **list, Callback *h)
+{
+    Callback **p;
+    for (p = list; *p; p = &(*p)->next)
+        if (*p == h) {
+            *p = h->next;
+            if (h->event == CB_NEW_DATA) {
+                h->running = 0;
+                if (!pthread_equal(h->thread, pthread_self()))
+                    pthread_join(h->thread, NULL);
+                else
+                    pthread_detach(h->thread);
+            }
+            free(h);
+            return;
+        }
+}
+
+/* Calls the new data handler of a node once per produced frame */
+static void *new_data(void *arg)
+{
+    Callback *cb = arg;
+    Node *n = cb->node;
+    uint32_t last = n->frameID;
+    while (cb->running) {
+        double t = now();
+        uint32_t f = produced(n, t);
+        if (f != last) {
+            last = f;
+            ((StateChangedHandler)cb->f)(n, cb->cookie);
+        }
+        sleep_until(n->generating ? frame_time(n, produced(n, now()) + 1) : now() + 0.01);
+    }
+    return NULL;
+}
+
+XnStatus xnRegisterToNewDataAvailable(Node *n, StateChangedHandler f, void *cookie, Callback **ph)
+{
+    XnStatus status;
+    if (!n || !f)
+        return SIM_BAD_PARAM;
+    status = add_callback(&n->callbacks, CB_NEW_DATA, (void (*)(void))f, NULL, cookie, n, ph);
+    if (status)
+        return status;
+    (*ph)->running = 1;
+    if (pthread_create(&(*ph)->thread, NULL, new_data, *ph)) {
+        (*ph)->running = 0;
+        n->callbacks = (*ph)->next;
+        free(*ph);
+        return SIM_ERROR;
+    }
+    return SIM_OK;
+}
+
+void xnUnregisterFromNewDataAvailable(Node *n, Callback *h) { if (n) remove_callback(&n->callbacks, h); }
+
+XnStatus xnRegisterToMapOutputModeChange(Node *n, StateChangedHandler f, void *cookie, Callback **ph)
+{
+    if (!n || !f)
+        return SIM_BAD_PARAM;
+    return add_callback(&n->callbacks, CB_MODE_CHANGE, (void (*)(void))f, NULL, cookie, n, ph);
+}
+
+void xnUnregisterFromMapOutputModeChange(Node *n, Callback *h) { if (n) remove_callback(&n->callbacks, h); }
+
+XnStatus xnRegisterToDepthFieldOfViewChange(Node *n, StateChangedHandler f, void *cookie, Callback **ph)
+{
+    if (!n || !f)
+        return SIM_BAD_PARAM;
+    return add_callback(&n->callbacks, CB_FOV_CHANGE, (void (*)(void))f, NULL, cookie, n, ph);
+}
+
+void xnUnregisterFromDepthFieldOfViewChange(Node *n, Callback *h) { if (n) remove_callback(&n->callbacks, h); }
+
+XnStatus xnRegisterUserCallbacks(Node *n, UserHandler newUser, UserHandler lostUser, void *cookie, Callback **ph)
+{
+    if (!n || n->type != SIM_USER)
+        return SIM_BAD_PARAM;
+    return add_callback(&n->callbacks, CB_USER, (void (*)(void))newUser, (void (*)(void))lostUser,
+                        cookie, n, ph);
+}
+
+void xnUnregisterUserCallbacks(Node *n, Callback *h) { if (n) remove_callback(&n->callbacks, h); }
+
+XnStatus xnRegisterToNodeCreation(Context *c, NodeCreationHandler f, void *cookie, Callback **ph)
+{
+    if (!c || !f)
+        return SIM_BAD_PARAM;
+    return add_callback(&c->callbacks, CB_NODE_CREATION, (void (*)(void))f, NULL, cookie, NULL, ph);
+}
+
+void xnUnregisterFromNodeCreation(Context *c, Callback *h) { if (c) remove_callback(&c->callbacks, h); }
+
+XnStatus xnRegisterToNodeDestruction(Context *c, NodeDestructionHandler f, void *cookie, Callback **ph)
+{
+    if (!c || !f)
+        return SIM_BAD_PARAM;
+    return add_callback(&c->callbacks, CB_NODE_DESTRUCTION, (void (*)(void))f, NULL, cookie, NULL, ph);
+}
+
+void xnUnregisterFromNodeDestruction(Context *c, Callback *h) { if (c) remove_callback(&c->callbacks, h); }
+
+/* Enumeration */
+
+XnStatus xnNodeInfoListAllocate(NodeInfoList **pp)
+{
+    if (!pp)
+        return SIM_BAD_PARAM;
+    *pp = calloc(1, sizeof(NodeInfoList));
+    return *pp ? SIM_OK : SIM_ERROR;
+}
+
+XnStatus xnNodeInfoListClear(NodeInfoList *l)
+{
+    if (!l)
+        return SIM_BAD_PARAM;
+    while (l->first) {
+        ListNode *next = l->first->next;
+        free(l->first);
+        l->first = next;
+    }
+    return SIM_OK;
+}
+
+void xnNodeInfoListFree(NodeInfoList *l)
+{
+    if (l) {
+        xnNodeInfoListClear(l);
+        free(l);
+    }
+}
+
+/* XnNodeInfoListIterator is a struct holding the list node pointer */
+ListNode *xnNodeInfoListGetFirst(NodeInfoList *l) { return l ? l->first : NULL; }
+ListNode *xnNodeInfoListGetNext(ListNode *it) { return it ? it->next : NULL; }
+ListNode *xnNodeInfoListGetPrevious(ListNode *it) { return it ? it->prev : NULL; }
+int xnNodeInfoListIteratorIsValid(ListNode *it) { return it != NULL; }
+NodeInfo *xnNodeInfoListGetCurrent(ListNode *it) { return it ? &it->info : NULL; }
+
+const char *xnNodeInfoGetCreationInfo(NodeInfo *info) { return info ? info->creationInfo : NULL; }
+
+XnStatus xnEnumerateProductionTrees(Context *c, int type, void *query, NodeInfoList **pp, void *errors)
+{
+    int i, devices = env("NI_SIM_DEVICES", 1);
+    ListNode **last, *prev = NULL;
+    XnStatus status;
+    if (!c || !pp)
+        return SIM_BAD_PARAM;
+    if (type != SIM_DEVICE && type != SIM_DEPTH && type != SIM_IMAGE && type != SIM_IR &&
+        type != SIM_USER && type != SIM_SCENE)
+        return SIM_NO_MATCH;
+    status = xnNodeInfoListAllocate(pp);
+    if (status)
+        return status;
+    last = &(*pp)->first;
+    for (i = 0; i < devices; i++) {
+        ListNode *e = calloc(1, sizeof(ListNode));
+        if (!e)
+            break;
+        e->info.type = type;
+        e->info.device = i;
+        snprintf(e->info.creationInfo, sizeof(e->info.creationInfo), "sim/%d", i);
+        e->prev = prev;
+        *last = prev = e;
+        last = &e->next;
+    }
+    return SIM_OK;
+}
+
+XnStatus xnCreateProductionTree(Context *c, NodeInfo *info, Node **ph)
+{
+    if (!info)
+        return SIM_BAD_PARAM;
+    return create(c, info->type, info->device, ph);
+}
+
+/* Queries: the needed node selects the device of the generators, see
+   create_generator; errors: accepted and ignored */
+
+XnStatus xnNodeQueryAllocate(Query **pp)
+{
+    if (!pp)
+        return SIM_BAD_PARAM;
+    *pp = calloc(1, sizeof(Query));
+    return *pp ? SIM_OK : SIM_ERROR;
+}
+
+void xnNodeQueryFree(Query *q) { free(q); }
+
+XnStatus xnNodeQueryAddNeededNode(Query *q, const char *name)
+{
+    if (!q || !name)
+        return SIM_BAD_PARAM;
+    snprintf(q->needed, sizeof(q->needed), "%s", name);
+    return SIM_OK;
+}
+
+XnStatus xnEnumerationErrorsAllocate(void **pp)
+{
+    if (!pp)
+        return SIM_BAD_PARAM;
+    *pp = calloc(1, 1);
+    return SIM_OK;
+}
+
+void xnEnumerationErrorsFree(void *e) { free(e); }
+XnStatus xnEnumerationErrorsClear(void *e) { return e ? SIM_OK : SIM_BAD_PARAM; }
+
+/* Properties: a table per node, see create */
+
+/* The property name of node n, of type type, NULL if there is none or
+   of another type.  With add, a missing property is added, a property
+   of another type replaced. */
+static Property *property(Node *n, const char *name, int type, int add)
+{
+    int i;
+    Property *p = NULL;
+    if (!n || !name || strlen(name) >= sizeof(p->name))
+        return NULL;
+    for (i = 0; i < n->nproperties; i++)
+        if (!strcmp(n->properties[i].name, name)) {
+            p = &n->properties[i];
+            break;
+        }
+    if (!add)
+        return p && p->type == type ? p : NULL;
+    if (!p) {
+        if (n->nproperties >= MAX_PROPERTIES)
+            return NULL;
+        p = &n->properties[n->nproperties++];
+        strcpy(p->name, name);
+    }
+    p->type = type;
+    return p;
+}
+
+XnStatus xnGetIntProperty(Node *n, const char *name, uint64_t *value)
+{
+    Property *p = property(n, name, PROP_INT, 0);
+    if (!p || !value)
+        return n && value ? SIM_NO_PROPERTY : SIM_BAD_PARAM;
+    *value = p->i;
+    return SIM_OK;
+}
+
+XnStatus xnGetRealProperty(Node *n, const char *name, double *value)
+{
+    Property *p = property(n, name, PROP_REAL, 0);
+    if (!p || !value)
+        return n && value ? SIM_NO_PROPERTY : SIM_BAD_PARAM;
+    *value = p->r;
+    return SIM_OK;
+}
+
+XnStatus xnGetStringProperty(Node *n, const char *name, char *value, uint32_t size)
+{
+    Property *p = property(n, name, PROP_STRING, 0);
+    if (!p || !value || !size)
+        return n && value && size ? SIM_NO_PROPERTY : SIM_BAD_PARAM;
+    snprintf(value, size, "%s", p->s);
+    return SIM_OK;
+}
+
+XnStatus xnSetIntProperty(Node *n, const char *name, uint64_t value)
+{
+    Property *p = property(n, name, PROP_INT, 1);
+    if (!p)
+        return SIM_BAD_PARAM;
+    p->i = value;
+    return SIM_OK;
+}
+
+XnStatus xnSetRealProperty(Node *n, const char *name, double value)
+{
+    Property *p = property(n, name, PROP_REAL, 1);
+    if (!p)
+        return SIM_BAD_PARAM;
+    p->r = value;
+    return SIM_OK;
+}
+
+XnStatus xnSetStringProperty(Node *n, const char *name, const char *value)
+{
+    Property *p = property(n, name, PROP_STRING, 1);
+    if (!p || !value)
+        return SIM_BAD_PARAM;
+    snprintf(p->s, sizeof(p->s), "%s", value);
+    return SIM_OK;
+}
+
+/* Errors */
+
+const char *xnGetStatusString(XnStatus status)
+{
+    switch (status) {
+    case SIM_OK: return "OK";
+    case SIM_ERROR: return "Simulated error";
+    case SIM_BAD_PARAM: return "Bad parameter";
+    case SIM_NO_MATCH: return "No match";
+    case SIM_NOT_GENERATING: return "No generating node";
+    case SIM_JOINT_INACTIVE: return "Joint is not active";
+    case SIM_NO_PROPERTY: return "Property not found";
+    }
+    return "Unknown error";
+}
+
+const char *xnGetStatusName(XnStatus status) { return xnGetStatusString(status); }
+
+void xnPrintError(XnStatus status, const char *what)
+{
+    printf("%s failed: %s\n", what, xnGetStatusString(status));
+}